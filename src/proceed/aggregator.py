@@ -45,13 +45,36 @@ def safe_read_execution_record(yaml_file: Path) -> ExecutionRecord:
 def summarize_execution(results_id: str, group: str, execution_record: ExecutionRecord) -> list[dict[str, str]]:
     pipeline_summary = summarize_pipeline(results_id, group, execution_record.amended, execution_record.timing)
 
-    steps_and_results = zip(execution_record.amended.steps, execution_record.step_results)
+    steps_and_results = pair_steps_and_results(execution_record.amended.steps, execution_record.step_results)
     step_summaries = [summarize_step_and_result(step, result) for step, result in steps_and_results]
 
     combined_summary = [{**pipeline_summary, **file_summary} for step_summary in step_summaries for file_summary in step_summary]
     return combined_summary
 
 
+def pair_steps_and_results(steps: list[Step], step_results: list[StepResult]) -> list[tuple[Step, StepResult]]:
+    """Pair each step result with the step of the same name.
+
+    Results don't always line up with steps by position, for example when
+    only some steps were run, or when a step had an error while others were running in parallel.
+    Steps that share a name are paired with results in order.
+    """
+    steps_by_name = {}
+    for step in steps:
+        steps_by_name.setdefault(step.name, []).append(step)
+
+    steps_and_results = []
+    for result in step_results:
+        named_steps = steps_by_name.get(result.name)
+        if named_steps:
+            step = named_steps.pop(0)
+        else:
+            logging.warning(f"No step found for step result named '{result.name}'.")
+            step = Step()
+        steps_and_results.append((step, result))
+    return steps_and_results
+
+
 def summarize_pipeline(results_id: str, group: str, pipeline: Pipeline, timing: Timing) -> dict[str, str]:
     top_level_summary = {
         "proceed_version": pipeline.version,
@@ -76,7 +76,9 @@ def run(spec: str, config_options: ConfigOptions) -> int:
         execution_path=execution_path,
         args=config_options.args.value,
         force_rerun=config_options.force_rerun.value,
-        step_names=config_options.step_names.value)
+        step_names=config_options.step_names.value,
+        max_parallel=config_options.max_parallel.value,
+        coalesce_duplicates=config_options.coalesce_duplicates.value)
 
     record_path = Path(execution_path, "execution_record.yaml")
     logging.info(f"Writing execution record to: {record_path}")
@@ -132,6 +132,23 @@ class ConfigOptions():
         cli_help_default="run all steps",
     ))
 
+    max_parallel: ConfigOption = field(default_factory=lambda: ConfigOption(
+        value=1,
+        cli_long_name="--max-parallel",
+        cli_short_name="-p",
+        cli_type=int,
+        cli_help="how many steps may run at the same time, when they don't depend on each other",
+    ))
+
+    coalesce_duplicates: ConfigOption = field(default_factory=lambda: ConfigOption(
+        value=False,
+        cli_long_name="--coalesce-duplicates",
+        cli_short_name="-C",
+        cli_action="store_true",
+        cli_type=None,
+        cli_help="let steps with the same container spec as an earlier step reuse the earlier step's run",
+    ))
+
     summary_file: ConfigOption = field(default_factory=lambda: ConfigOption(
         value="./summary.csv",
         cli_long_name="--summary-file",
@@ -1,14 +1,95 @@
 import logging
-from typing import Union, Any
+from typing import Union, Any, Iterable
+from functools import lru_cache
+from dataclasses import replace
 from datetime import datetime, timezone
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 from os import getuid, getgid, environ
+from os.path import abspath
 from grp import getgrnam
+from time import monotonic, monotonic_ns
+from heapq import heapify, heappop, heappush
+from fnmatch import fnmatchcase
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from threading import Event, Lock, Thread
+from urllib.parse import urlparse
+import atexit
+import json
+import shlex
 import docker
 from docker.models.containers import Container
-from docker.errors import DockerException, APIError
+from docker.errors import DockerException, APIError, NotFound
 from proceed.model import Pipeline, ExecutionRecord, Step, StepResult, Timing
-from proceed.file_matching import count_matches, match_patterns_in_dirs
+from proceed.file_matching import DirIndex, count_matches, match_patterns_in_dirs, match_pattern_groups, pattern_lists_dir
+
+
+class WarmContainers():
+    """Running containers shared by steps with Step.reuse_container, keyed by client and container config.
+
+    Each pipeline run keeps its own WarmContainers, so it can remove the containers it started without affecting other runs.
+    Starting a container can take a while, for example to pull its image, so this locks per key instead of for all keys.
+    """
+
+    def __init__(self):
+        self.containers = {}
+        self.key_locks = {}
+        self.lock = Lock()
+
+    def container(
+        self,
+        client: docker.DockerClient,
+        key: tuple,
+        step: Step,
+        volumes: dict[str, dict[str, str]]
+    ) -> Container:
+        """Get a running container to share for the given key, starting a new one as needed."""
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, Lock())
+
+        with key_lock:
+            with self.lock:
+                container = self.containers.get(key)
+            if container is not None:
+                try:
+                    container.reload()
+                    if container.status == "running":
+                        return container
+                    container.remove(force=True)
+                except NotFound:
+                    pass
+                logging.info(f"Container '{step.name}': shared container stopped, will start a new one.")
+
+            logging.info(f"Container '{step.name}': starting a shared container.")
+            container = client.containers.run(
+                step.image,
+                entrypoint=["tail", "-f", "/dev/null"],
+                network_mode=step.network_mode,
+                mac_address=step.mac_address,
+                volumes=volumes,
+                auto_remove=False,
+                remove=False,
+                detach=True,
+                shm_size=step.shm_size,
+                privileged=step.privileged
+            )
+            with self.lock:
+                self.containers[key] = container
+            return container
+
+    def remove_all(self):
+        """Stop and remove all the containers that steps were sharing."""
+        with self.lock:
+            containers = list(self.containers.values())
+            self.containers.clear()
+        for container in containers:
+            try:
+                container.remove(force=True)
+            except DockerException:
+                logging.warning(f"Unable to remove shared container {container.id}.", exc_info=True)
+
+
+# Shared containers for steps that run outside of run_pipeline(), removed at exit.
+default_warm_containers = WarmContainers()
 
 
 def run_pipeline(
@@ -17,12 +98,16 @@ def run_pipeline(
         args: dict[str, str] = {},
         force_rerun: bool = False,
         step_names: list[str] = None,
-        client_kwargs: dict[str, Any] = {}
+        client_kwargs: dict[str, Any] = {},
+        max_parallel: int = 1,
+        coalesce_duplicates: bool = False
 ) -> ExecutionRecord:
     """
     Run steps of a pipeline and return results.
 
     :param original: a Pipeline, as read from an input YAML spec
+    :param max_parallel: how many steps may run at the same time, when they don't depend on each other
+    :param coalesce_duplicates: whether steps with the same container spec as an earlier step should reuse its run
     :return: a summary of Pipeline execution results.
 
     """
@@ -30,24 +115,80 @@ def run_pipeline(
     logging.info("Starting pipeline run.")
 
     start = datetime.now(timezone.utc)
+    start_ns = monotonic_ns()
 
     amended = original._with_args_applied(args)._with_prototype_applied()
-    step_results = []
+    amended_steps = []
+    steps_to_run = []
     for step in amended.steps:
         if step_names and not step.name in step_names:
             logging.info(f"Ignoring step '{step.name}', not in list of steps to run: {step_names}")
+            amended_steps.append(step)
             continue
 
-        log_stem = step.name.replace(" ", "_")
-        log_path = Path(execution_path, f"{log_stem}.log")
-        step_result = run_step(step, log_path, force_rerun, client_kwargs)
-        step_results.append(step_result)
-        if step_result.exit_code:
-            logging.error("Stopping pipeline run after error.")
-            break
+        # Set up X11 here, so the amended pipeline in the execution record shows what actually ran.
+        step = apply_step_X11(step)
+        amended_steps.append(step)
+        steps_to_run.append(step)
+    amended = replace(amended, steps=amended_steps)
+
+    # Share dir listings across steps, so steps can match files without listing the same dirs again.
+    # List volumes that steps will search for done files up front, in parallel rather than one step at a time.
+    # Listings are invalidated as containers run, so these won't hide files written by earlier steps.
+    dir_index = DirIndex()
+    dir_index.prefetch([
+        volume_dir
+        for step in steps_to_run if any(pattern_lists_dir(pattern) for pattern in step.match_done)
+        for volume_dir in step.volumes.keys()
+    ])
+
+    # Record each step result as soon as it's available, in case the pipeline run doesn't make it to the end.
+    step_results_path = Path(execution_path, "step_results.yaml")
+    start_step_results(step_results_path)
+
+    if coalesce_duplicates:
+        duplicates = find_duplicate_steps(steps_to_run)
+    else:
+        duplicates = {}
+
+    # Keep track of containers that steps share via Step.reuse_container, for just this run.
+    warm_containers = WarmContainers()
+
+    try:
+        if max_parallel > 1:
+            step_results = run_steps_in_parallel(
+                steps_to_run,
+                execution_path,
+                force_rerun,
+                client_kwargs,
+                max_parallel,
+                dir_index,
+                step_results_path,
+                duplicates,
+                warm_containers
+            )
+        else:
+            step_results = []
+            for index, step in enumerate(steps_to_run):
+                step_result = run_step(
+                    step,
+                    step_log_path(execution_path, step),
+                    force_rerun,
+                    client_kwargs,
+                    dir_index,
+                    coalescable_result(index, duplicates, step_results),
+                    warm_containers
+                )
+                record_step_result(step_results_path, step_result)
+                step_results.append(step_result)
+                if step_result.exit_code:
+                    logging.error("Stopping pipeline run after error.")
+                    break
+    finally:
+        # Clean up containers that steps were sharing via Step.reuse_container, leaving other runs alone.
+        warm_containers.remove_all()
 
-    finish = datetime.now(timezone.utc)
-    duration = finish - start
+    finish_ns = monotonic_ns()
 
     logging.info("Finished pipeline run.")
 
@@ -55,35 +196,290 @@ def run_pipeline(
         original=original,
         amended=amended,
         step_results=step_results,
-        timing=Timing(start.isoformat(sep="T"), finish.isoformat(sep="T"), duration.total_seconds())
+        timing=Timing.from_monotonic(start, start_ns, finish_ns)
     )
 
 
+def step_log_path(execution_path: Path, step: Step) -> Path:
+    log_stem = step.name.replace(" ", "_")
+    return Path(execution_path, f"{log_stem}.log")
+
+
+def start_step_results(step_results_path: Path):
+    """Create or truncate a multi-document YAML file for step results, so results from earlier runs don't pile up."""
+    with open(step_results_path, 'w'):
+        pass
+
+
+def record_step_result(step_results_path: Path, step_result: StepResult):
+    """Append a step result to a multi-document YAML file, as a separate YAML document."""
+    if step_results_path is None:
+        return
+
+    with open(step_results_path, 'a') as f:
+        f.write("---\n")
+        f.write(step_result.to_yaml())
+
+
+def find_duplicate_steps(steps: list[Step]) -> dict[int, int]:
+    """Find steps that would run the same container as an earlier step, map their indices to the earlier step's index."""
+    first_index_by_spec = {}
+    duplicates = {}
+    for index, step in enumerate(steps):
+        container_spec = {
+            "image": step.image,
+            "command": step.command,
+            "environment": step.environment,
+            "volumes": step.volumes,
+            "working_dir": step.working_dir,
+            "gpus": step.gpus,
+            "user": step.user,
+            "network_mode": step.network_mode,
+            "mac_address": step.mac_address,
+            "shm_size": step.shm_size,
+            "privileged": step.privileged,
+            "X11": step.X11,
+        }
+        spec_key = json.dumps(container_spec, sort_keys=True, default=str)
+        if spec_key in first_index_by_spec:
+            duplicates[index] = first_index_by_spec[spec_key]
+            logging.info(f"Step '{step.name}' has the same container spec as step '{steps[duplicates[index]].name}'.")
+        else:
+            first_index_by_spec[spec_key] = index
+    return duplicates
+
+
+def coalescable_result(
+    index: int,
+    duplicates: dict[int, int],
+    step_results: Union[list[StepResult], dict[int, StepResult]]
+) -> StepResult:
+    """Get the result of an earlier step that the indexed step can reuse, or None if the step should run on its own.
+
+    Only completed, successful container runs can be reused.
+    """
+    if index not in duplicates:
+        return None
+
+    first_index = duplicates[index]
+    if isinstance(step_results, list):
+        first_result = step_results[first_index] if first_index < len(step_results) else None
+    else:
+        first_result = step_results.get(first_index, None)
+
+    if first_result is None or first_result.skipped or first_result.exit_code:
+        return None
+    return first_result
+
+
+def run_steps_in_parallel(
+    steps: list[Step],
+    execution_path: Path,
+    force_rerun: bool = False,
+    client_kwargs: dict[str, Any] = {},
+    max_parallel: int = 2,
+    dir_index: DirIndex = None,
+    step_results_path: Path = None,
+    duplicates: dict[int, int] = {},
+    warm_containers: WarmContainers = None
+) -> list[StepResult]:
+    """Run steps as soon as the steps they depend on have finished, return results in the same order as steps.
+
+    This keeps at most max_parallel steps running at a time.
+    When several steps are ready to run, the one that comes first in the pipeline goes first.
+    After any step has an error no new steps will start, but steps already running will finish.
+    """
+    (predecessors, successors) = _build_dag(steps)
+
+    # Steps that might reuse an earlier step's container run have to wait for that step.
+    for index, first_index in duplicates.items():
+        predecessors[index].add(first_index)
+        successors[first_index].add(index)
+
+    waiting_on = [len(step_predecessors) for step_predecessors in predecessors]
+    ready = [index for index, count in enumerate(waiting_on) if count == 0]
+    heapify(ready)
+
+    step_results = {}
+    running = {}
+    stopping = False
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        while running or (ready and not stopping):
+            while ready and not stopping and len(running) < max_parallel:
+                index = heappop(ready)
+                step = steps[index]
+                future = executor.submit(
+                    run_step,
+                    step,
+                    step_log_path(execution_path, step),
+                    force_rerun,
+                    client_kwargs,
+                    dir_index,
+                    coalescable_result(index, duplicates, step_results),
+                    warm_containers
+                )
+                running[future] = index
+
+            (done, _) = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = running.pop(future)
+                step_result = future.result()
+                record_step_result(step_results_path, step_result)
+                step_results[index] = step_result
+                if step_result.exit_code:
+                    if not stopping:
+                        logging.error("Stopping pipeline run after error.")
+                    stopping = True
+
+                for successor in successors[index]:
+                    waiting_on[successor] -= 1
+                    if not waiting_on[successor]:
+                        heappush(ready, successor)
+
+    return [step_results[index] for index in sorted(step_results)]
+
+
+def _build_dag(steps: list[Step]) -> tuple[list[set[int]], list[set[int]]]:
+    """Find the indices of earlier steps that each step depends on, and later steps that depend on each step.
+
+    Dependencies come from explicit Step.depends_on, plus steps that might touch the same files.
+    """
+    predecessors = [set() for _ in steps]
+    successors = [set() for _ in steps]
+    index_by_name = {}
+    for index, step in enumerate(steps):
+        for name in step.depends_on:
+            if name in index_by_name:
+                predecessors[index].add(index_by_name[name])
+            else:
+                logging.warning(f"Step '{step.name}': ignoring depends_on '{name}', which is not an earlier step to run.")
+
+        for earlier_index in range(index):
+            if _steps_might_conflict(steps[earlier_index], step):
+                predecessors[index].add(earlier_index)
+
+        for predecessor in predecessors[index]:
+            successors[predecessor].add(index)
+
+        index_by_name[step.name] = index
+
+    return (predecessors, successors)
+
+
+def _steps_might_conflict(a: Step, b: Step) -> bool:
+    """Could one step write files that the other step reads or writes?
+
+    This is conservative: steps that share a volume might conflict unless both declare
+    match_out patterns for what they write, and no patterns for one step could match the
+    same file as match_out patterns for the other.
+    """
+    a_volumes = {Path(abspath(host_path)) for host_path in a.volumes.keys()}
+    b_volumes = {Path(abspath(host_path)) for host_path in b.volumes.keys()}
+    same_volumes = a_volumes.intersection(b_volumes)
+    for a_volume in a_volumes:
+        for b_volume in b_volumes:
+            if a_volume != b_volume and (a_volume.is_relative_to(b_volume) or b_volume.is_relative_to(a_volume)):
+                # Patterns are relative to different, nested dirs -- too hard to compare, assume the worst.
+                return True
+
+    if not same_volumes:
+        return False
+
+    if not a.match_out or not b.match_out:
+        # We don't know what this step writes, assume the worst.
+        return True
+
+    a_patterns = a.match_done + a.match_in + a.match_out
+    b_patterns = b.match_done + b.match_in + b.match_out
+    a_writes_b = any(_patterns_might_overlap(a_out, b_pattern) for a_out in a.match_out for b_pattern in b_patterns)
+    b_writes_a = any(_patterns_might_overlap(b_out, a_pattern) for b_out in b.match_out for a_pattern in a_patterns)
+    return a_writes_b or b_writes_a
+
+
+def _patterns_might_overlap(a: str, b: str) -> bool:
+    """Could two glob patterns match the same file?
+
+    This is conservative: it may say patterns overlap when they don't, but not the other way around.
+    Patterns are compared component by component, where "**" can stand for any number of components.
+    """
+    a_parts = PurePosixPath(a).parts
+    b_parts = PurePosixPath(b).parts
+    if not a_parts or not b_parts or a_parts[0] == "/" or b_parts[0] == "/":
+        # Unusual patterns -- assume the worst.
+        return True
+    return _glob_parts_might_overlap(a_parts, b_parts)
+
+
+@lru_cache(maxsize=1024)
+def _glob_parts_might_overlap(a_parts: tuple[str], b_parts: tuple[str]) -> bool:
+    if a_parts and a_parts[0] == "**":
+        # "**" matches zero components, or one component and maybe more.
+        return _glob_parts_might_overlap(a_parts[1:], b_parts) or (
+            bool(b_parts) and _glob_parts_might_overlap(a_parts, b_parts[1:]))
+    if b_parts and b_parts[0] == "**":
+        return _glob_parts_might_overlap(b_parts, a_parts)
+    if not a_parts or not b_parts:
+        return not a_parts and not b_parts
+    return _glob_components_might_overlap(a_parts[0], b_parts[0]) and _glob_parts_might_overlap(a_parts[1:], b_parts[1:])
+
+
+def _glob_components_might_overlap(a: str, b: str) -> bool:
+    """Could two glob pattern components, without "/", match the same name?"""
+    a_is_literal = not any(c in a for c in "*?[")
+    b_is_literal = not any(c in b for c in "*?[")
+    if a_is_literal and b_is_literal:
+        return a == b
+    elif a_is_literal:
+        return fnmatchcase(a, b)
+    elif b_is_literal:
+        return fnmatchcase(b, a)
+
+    # Both have wildcards, so only rule out overlap when their literal beginnings or endings disagree.
+    (a_prefix, a_suffix) = _glob_literal_ends(a)
+    (b_prefix, b_suffix) = _glob_literal_ends(b)
+    prefixes_agree = a_prefix.startswith(b_prefix) or b_prefix.startswith(a_prefix)
+    suffixes_agree = a_suffix.endswith(b_suffix) or b_suffix.endswith(a_suffix)
+    return prefixes_agree and suffixes_agree
+
+
+def _glob_literal_ends(component: str) -> tuple[str, str]:
+    """Get literal text that every name matching a glob component must start and end with."""
+    special = "*?[]"
+    first = min(component.index(c) for c in special if c in component)
+    last = max(component.rindex(c) for c in special if c in component)
+    return (component[:first], component[last + 1:])
+
+
 def apply_step_X11(
     step: Step,
 ) -> Step:
-    """Set up the step as an X11 gui client with DISPLAY access.
+    """Return a copy of the step, set up as an X11 gui client with DISPLAY access, or the step itself if already set up.
 
     This is implemented here in the docker_runner and not in the model
     because the intended behavior depends on the runtime system and environment.
     """
 
     if not step.X11:
-        return
+        return step
 
-    if "DISPLAY" not in step.environment:
+    # Work on copies, to leave the given step as it was.
+    environment = dict(step.environment)
+    volumes = dict(step.volumes)
+    network_mode = step.network_mode
+
+    if "DISPLAY" not in environment:
         display = environ.get("DISPLAY")
         logging.info(f"Step '{step.name}': using X11 DISPLAY: {display}")
-        step.environment["DISPLAY"] = display
+        environment["DISPLAY"] = display
 
     local_socket_dir = Path("/tmp/.X11-unix").as_posix()
-    if local_socket_dir not in step.volumes:
+    if local_socket_dir not in volumes:
         logging.info(f"Step '{step.name}': using X11 local socket dir: {local_socket_dir}")
-        step.volumes[local_socket_dir] = local_socket_dir
+        volumes[local_socket_dir] = local_socket_dir
 
-    if step.network_mode is None:
+    if network_mode is None:
         logging.info(f"Step '{step.name}': using network_mode host for X11 support")
-        step.network_mode = "host"
+        network_mode = "host"
 
     default_xauthority = Path("~", ".Xauthority").as_posix()
     xauthority = environ.get("XAUTHORITY", default_xauthority)
@@ -94,39 +490,48 @@ def apply_step_X11(
         logging.info(f"Step '{step.name}': found .Xauthority cookie file on host at {xauthority_host}")
 
         xauthority_container = "/var/.Xauthority"
-        if xauthority_host not in step.volumes:
+        if xauthority_host not in volumes:
             logging.info(f"Step '{step.name}': adding .Xauthority cookie file to container at {xauthority_container}")
-            step.volumes[xauthority_host] = xauthority_container
+            volumes[xauthority_host] = xauthority_container
 
-        if "XAUTHORITY" not in step.environment:
+        if "XAUTHORITY" not in environment:
             logging.info(f"Step '{step.name}': setting XAUTHORITY env var in container to {xauthority_container}")
-            step.environment["XAUTHORITY"] = xauthority_container
+            environment["XAUTHORITY"] = xauthority_container
 
-    return step
+    if environment == step.environment and volumes == step.volumes and network_mode == step.network_mode:
+        # Already set up, for example by run_pipeline() before run_step().
+        return step
+    return replace(step, environment=environment, volumes=volumes, network_mode=network_mode)
 
 
 def run_step(
     step: Step,
     log_path: Path,
     force_rerun: bool = False,
-    client_kwargs: dict[str, Any] = {}
+    client_kwargs: dict[str, Any] = {},
+    dir_index: DirIndex = None,
+    coalesce_with: StepResult = None,
+    warm_containers: WarmContainers = None
 ) -> StepResult:
     logging.info(f"Step '{step.name}': starting.")
 
-    apply_step_X11(step)
+    step = apply_step_X11(step)
 
     start = datetime.now(timezone.utc)
+    start_ns = monotonic_ns()
 
-    # Create volume dirs on the host as the current user.
-    # This is nicer than having dockerd create them as root!
     volume_dirs = step.volumes.keys()
-    for volume_dir in volume_dirs:
-        volume_path = Path(volume_dir)
-        if not volume_path.exists():
-            logging.info(f"Step '{step.name}': creating host directory: {volume_path}")
-            volume_path.mkdir(parents=True, exist_ok=True)
 
-    files_done = match_patterns_in_dirs(volume_dirs, step.match_done)
+    # Reuse dir listings across file matching before and after the container runs.
+    if dir_index is None:
+        dir_index = DirIndex()
+
+    # Check for done files first, so that skipped steps don't need to touch the host file system at all.
+    if step.match_done:
+        files_done = match_patterns_in_dirs(volume_dirs, step.match_done, dir_index)
+    else:
+        files_done = {}
+
     if files_done:
         logging.info(f"Step '{step.name}': found {count_matches(files_done)} done files.")
 
@@ -138,55 +543,85 @@ def run_step(
                 name=step.name,
                 skipped=True,
                 files_done=files_done,
-                timing=Timing(start.isoformat(sep="T"))
+                timing=Timing.from_monotonic(start, start_ns)
             )
 
-    files_in = match_patterns_in_dirs(volume_dirs, step.match_in)
+    # Create volume dirs on the host as the current user.
+    # This is nicer than having dockerd create them as root!
+    for volume_dir in volume_dirs:
+        volume_path = Path(volume_dir)
+        if not volume_path.exists():
+            logging.info(f"Step '{step.name}': creating host directory: {volume_path}")
+            volume_path.mkdir(parents=True, exist_ok=True)
+
+    files_in = match_patterns_in_dirs(volume_dirs, step.match_in, dir_index)
     logging.info(f"Step '{step.name}': found {count_matches(files_in)} input files.")
 
-    (container, exit_code, exception) = run_container(step, log_path, client_kwargs)
+    if coalesce_with is None:
+        (container, exit_code, exception) = run_container(step, log_path, client_kwargs, warm_containers=warm_containers)
 
-    if exception is not None:
-        # The container completed with an error.
-        error_type_name = type(exception).__name__
-        if isinstance(exception, APIError):
-            error_message = f"{error_type_name}: {exception.explanation}\n"
-        else:
-            error_message = f"{error_type_name}: {exception.args}\n"
+        # The container might have changed files in any of its volumes.
+        dir_index.invalidate(volume_dirs)
+
+        if exception is not None:
+            # The container completed with an error.
+            error_type_name = type(exception).__name__
+            if isinstance(exception, APIError):
+                error_message = f"{error_type_name}: {exception.explanation}\n"
+            else:
+                error_message = f"{error_type_name}: {exception.args}\n"
+
+            with open(log_path, 'a') as f:
+                f.write(error_message)
 
-        with open(log_path, 'a') as f:
-            f.write(error_message)
+            logging.error(f"Step '{step.name}': error (see stack trace above) {error_message}")
+            return StepResult(
+                name=step.name,
+                log_file=log_path.as_posix(),
+                timing=Timing.from_monotonic(start, start_ns),
+                exit_code=exit_code
+            )
 
-        logging.error(f"Step '{step.name}': error (see stack trace above) {error_message}")
-        return StepResult(
-            name=step.name,
-            log_file=log_path.as_posix(),
-            timing=Timing(start.isoformat(sep="T")),
-            exit_code=exit_code
-        )
+        image_id = container.image.id
+        log_file = log_path.as_posix()
+        coalesced_with = None
+    else:
+        # An earlier step already ran the same container, so reuse its results instead of running it again.
+        logging.info(f"Step '{step.name}': reusing the container run from step '{coalesce_with.name}'.")
+        exit_code = coalesce_with.exit_code
+        image_id = coalesce_with.image_id
+        log_file = coalesce_with.log_file
+        coalesced_with = coalesce_with.name
 
     # It seems the container completed OK.
-    files_out = match_patterns_in_dirs(volume_dirs, step.match_out)
+    # Match output and summary files together, to check and hash each file once.
+    matches_after = match_pattern_groups(
+        volume_dirs,
+        {"out": step.match_out, "summary": step.match_summary},
+        dir_index
+    )
+
+    files_out = matches_after["out"]
     logging.info(f"Step '{step.name}': found {count_matches(files_out)} output files.")
 
-    files_summary = match_patterns_in_dirs(volume_dirs, step.match_summary)
+    files_summary = matches_after["summary"]
     logging.info(f"Step '{step.name}': found {count_matches(files_summary)} summary files.")
 
-    finish = datetime.now(timezone.utc)
-    duration = finish - start
+    finish_ns = monotonic_ns()
 
     logging.info(f"Step '{step.name}': finished.")
 
     return StepResult(
         name=step.name,
-        image_id=container.image.id,
+        image_id=image_id,
         exit_code=exit_code,
-        log_file=log_path.as_posix(),
+        log_file=log_file,
         files_done=files_done,
         files_in=files_in,
         files_out=files_out,
         files_summary=files_summary,
-        timing=Timing(start.isoformat(sep="T"), finish.isoformat(sep="T"), duration.total_seconds()),
+        timing=Timing.from_monotonic(start, start_ns, finish_ns),
+        coalesced_with=coalesced_with
     )
 
 
@@ -219,97 +654,439 @@ def resolve_user(user: str) -> str:
     return user
 
 
+# Docker clients to reuse across steps and attempts, keyed by client kwargs.
+_docker_clients = {}
+_docker_clients_lock = Lock()
+
+
+def _docker_client_key(client_kwargs: dict[str, Any]) -> frozenset:
+    """Make a cache key from client kwargs, or None if the kwargs can't be used as a key."""
+    try:
+        return frozenset(client_kwargs.items())
+    except (AttributeError, TypeError):
+        return None
+
+
+def docker_client(client_kwargs: dict[str, Any] = {}) -> docker.DockerClient:
+    """Get a Docker client configured with the given kwargs, reusing an existing client when possible.
+
+    Creating a client means reading the environment and connecting to the Docker daemon.
+    Reusing clients lets steps and retries skip this setup.
+    """
+    key = _docker_client_key(client_kwargs)
+    if key is None:
+        # We can't cache this client, so just make a new one.
+        return new_docker_client(client_kwargs)
+
+    with _docker_clients_lock:
+        client = _docker_clients.get(key)
+        if client is None:
+            client = new_docker_client(client_kwargs)
+            _docker_clients[key] = client
+        return client
+
+
+local_docker_socket = "/var/run/docker.sock"
+
+
+def new_docker_client(client_kwargs: dict[str, Any] = {}) -> docker.DockerClient:
+    """Make a new Docker client configured from the environment, optionally preferring a local unix socket over local TCP.
+
+    With prefer_local_socket=True in client_kwargs, when DOCKER_HOST points to a TCP port on this host
+    and the local Docker unix socket exists, connect through the socket instead.
+    This avoids TCP overhead on the many API calls we make per step.
+    It's opt-in because the local port might be a different daemon than the socket, like an SSH tunnel or docker-in-docker.
+    Remote DOCKER_HOST, TLS settings, and an explicit base_url in client_kwargs are always used as-is.
+    """
+    socket_url = _local_socket_instead_of_tcp(client_kwargs)
+    if isinstance(client_kwargs, dict):
+        client_kwargs = {k: v for k, v in client_kwargs.items() if k != "prefer_local_socket"}
+
+    if socket_url:
+        logging.info(f"Connecting to the local Docker daemon through {socket_url} instead of TCP.")
+        socket_kwargs = {k: v for k, v in client_kwargs.items() if k not in {"environment", "use_context"}}
+        return docker.DockerClient(base_url=socket_url, **socket_kwargs)
+
+    return docker.from_env(**client_kwargs)
+
+
+docker_tls_variables = ["DOCKER_TLS_VERIFY", "DOCKER_CERT_PATH", "DOCKER_TLS"]
+
+
+def _local_socket_instead_of_tcp(client_kwargs: dict[str, Any]) -> str:
+    """Return the local unix socket URL to use instead of a local TCP DOCKER_HOST, or None."""
+    if not isinstance(client_kwargs, dict) or not client_kwargs.get("prefer_local_socket", False):
+        return None
+
+    if "base_url" in client_kwargs or "tls" in client_kwargs:
+        return None
+
+    environment = client_kwargs.get("environment") or environ
+    if any(environment.get(name) for name in docker_tls_variables):
+        return None
+
+    docker_host = urlparse(environment.get("DOCKER_HOST", ""))
+    if docker_host.scheme != "tcp" or docker_host.hostname not in {"localhost", "127.0.0.1", "::1"}:
+        return None
+
+    if not Path(local_docker_socket).is_socket():
+        return None
+
+    return f"unix://{local_docker_socket}"
+
+
+def forget_docker_client(client_kwargs: dict[str, Any] = {}):
+    """Stop reusing the client for the given kwargs, for example when its connection might be broken.
+
+    This doesn't close the client, since other steps might still be using it.
+    """
+    key = _docker_client_key(client_kwargs)
+    with _docker_clients_lock:
+        _docker_clients.pop(key, None)
+
+
+@atexit.register
+def close_docker_clients():
+    """Close and forget all the clients we were reusing."""
+    with _docker_clients_lock:
+        clients = list(_docker_clients.values())
+        _docker_clients.clear()
+    for client in clients:
+        client.close()
+
+
 def run_container(
     step: Step,
     log_path: Path,
     client_kwargs: dict[str, Any] = {},
-    max_attempts: int = 3
+    max_attempts: int = 3,
+    warm_containers: WarmContainers = None
 ) -> tuple[Container, int, Exception]:
+    # Resolve volume paths once for all attempts.
+    volumes = normalize_volumes(step.volumes)
+
+    warm_key = None
+    if step.reuse_container:
+        if step.gpus:
+            logging.info(f"Container '{step.name}': not reusing a container because the step requests gpus.")
+        else:
+            warm_key = warm_container_key(step, client_kwargs, volumes)
+
     retried_exception = None
+    container = None
+    log_drain = None
     attempts = 0
-    while attempts < max_attempts:
+    retry_log_messages = []
+    try:
+        while attempts < max_attempts:
+            try:
+                client = docker_client(client_kwargs)
+
+                if warm_key is not None:
+                    # Run the step command in a shared container that's already running.
+                    container_user = resolve_user(step.user)
+                    (warm, exit_code) = exec_in_warm_container(client, warm_key, step, volumes, container_user, log_path, warm_containers)
+                    logging.info(f"Container '{step.name}': process completed with exit code {exit_code}")
+                    return (warm, exit_code, None)
+
+                if container is not None:
+                    # A previous attempt created a container, try to pick up where that left off.
+                    container = reattach_container(client, container, step.name)
+
+                if container is None:
+                    device_requests = []
+                    if step.gpus:
+                        # This is roughly equivalent to the "--gpus" in "docker run --gpus ...".
+                        device_requests.append(docker.types.DeviceRequest(count=-1, capabilities=[["gpu"]]))
+
+                    container_user = resolve_user(step.user)
+                    if container_user is None:
+                        logging.info(f"Container '{step.name}': running as default user (might be root).")
+                    else:
+                        logging.info(f"Container '{step.name}': running as user {container_user}.")
+
+                    if step.privileged:
+                        logging.warning(f"Container '{step.name}' running in privileged mode.  Please only use this for troubleshooting.")
+
+                    log_drain = None
+                    container = client.containers.run(
+                        step.image,
+                        command=step.command,
+                        environment=step.environment,
+                        device_requests=device_requests,
+                        network_mode=step.network_mode,
+                        mac_address=step.mac_address,
+                        volumes=volumes,
+                        working_dir=step.working_dir,
+                        auto_remove=False,
+                        remove=False,
+                        detach=True,
+                        user=container_user,
+                        shm_size=step.shm_size,
+                        privileged=step.privileged,
+                        log_config=container_log_config(step)
+                    )
+                    logging.info(f"Container '{step.name}': waiting for process to complete.")
+
+                needs_log_drain = log_drain is None or (log_drain.done() and log_drain.exception() is not None)
+                if needs_log_drain and not step.short_lived:
+                    # Tail the container logs in the background, from the start, while we wait for the process to complete.
+                    open(log_path, 'wb').close()
+                    step_log_stream = container.logs(stdout=True, stderr=True, stream=True)
+                    log_drain = drain_container_logs(step.name, step_log_stream, log_path)
+
+                # Collect overall logs and status of the finished procedss.
+                run_results = container.wait()
+                exit_code = run_results['StatusCode']
+
+                if step.short_lived:
+                    # One request for all the logs, instead of a long-lived stream.
+                    open(log_path, 'wb').close()
+                    write_container_logs(step.name, [container.logs(stdout=True, stderr=True)], log_path)
+                else:
+                    # The log stream should end along with the process, so this should not take long.
+                    try:
+                        log_drain.result(timeout=log_drain_timeout)
+                    except TimeoutError:
+                        logging.warning(f"Container '{step.name}': logs still streaming after {log_drain_timeout}s, step log might be incomplete.")
+
+                logging.info(f"Container '{step.name}': process completed with exit code {exit_code}")
+
+                container.remove()
+
+                return (container, exit_code, None)
+
+            except APIError as api_error:
+                if api_error.is_client_error():
+                    # Client errors are not worth retrying, just fail out.
+                    logging.error(f"Container had a Docker client error.", exc_info=True)
+                    return (None, -1, api_error)
+                else:
+                    # Server errors might be transient and are worth retrying.
+                    logging.error(f"Container had a Docker server error, will retry.", exc_info=True)
+                    retried_exception = api_error
+                    forget_docker_client(client_kwargs)
+
+            except DockerException as docker_exception:
+                # The other DockerExceptions besides APIError are probably not worth retrying, so just fail out.
+                # https://github.com/docker/docker-py/blob/main/docker/errors.py
+                logging.error(f"Container had a Docker error.", exc_info=True)
+                return (None, -1, docker_exception)
+
+            except Exception as unexpected_exception:
+                # Other exceptions besides DockerException are unexpected!
+                # But we have seen OSError here, for one.
+                # Some of these seem to be transient, so we can retry them.
+                logging.error(f"Container had an unexpected, non-Docker error, will retry", exc_info=True)
+                retried_exception = unexpected_exception
+                forget_docker_client(client_kwargs)
+
+            attempts += 1
+            retry_log_message = f"Container attempts/retries at {attempts} out of {max_attempts}.\n"
+            retry_log_messages.append(retry_log_message)
+            logging.info(retry_log_message.strip())
+
+        # If we got here it means we exhausted max_attempts, so we expect retried_exception to be filed in.
+        return (None, -1, retried_exception)
+    finally:
+        # Add notes about retries to the step log all at once, after any container logs.
+        if retry_log_messages:
+            with open(log_path, 'a') as f:
+                f.write("".join(retry_log_messages))
+
+
+# Defaults for Step.log_driver, Step.log_mode, and Step.log_max_buffer.
+default_log_driver = "local"
+default_log_mode = "non-blocking"
+default_log_max_buffer = "25m"
+
+
+def container_log_config(step: Step) -> docker.types.LogConfig:
+    """Choose the Docker logging driver and options for a step's container."""
+    log_mode = step.log_mode or default_log_mode
+    log_options = {"mode": log_mode}
+    if log_mode == "non-blocking":
+        log_options["max-buffer-size"] = step.log_max_buffer or default_log_max_buffer
+    return docker.types.LogConfig(type=step.log_driver or default_log_driver, config=log_options)
+
+
+def reattach_container(client: docker.DockerClient, container: Container, step_name: str) -> Container:
+    """Look up a container from a previous attempt, return None if it no longer exists."""
+    try:
+        container = client.containers.get(container.id)
+        logging.info(f"Container '{step_name}': reattaching to existing container with status '{container.status}'.")
+        return container
+    except NotFound:
+        logging.info(f"Container '{step_name}': previous container no longer exists, will create a new one.")
+        return None
+
+
+def warm_container_key(step: Step, client_kwargs: dict[str, Any], volumes: dict[str, dict[str, str]]) -> tuple:
+    """Choose a key for steps that can share a running container, or None if the step can't share."""
+    client_key = _docker_client_key(client_kwargs)
+    if client_key is None:
+        return None
+
+    container_config = {
+        "image": step.image,
+        "volumes": volumes,
+        "network_mode": step.network_mode,
+        "mac_address": step.mac_address,
+        "shm_size": step.shm_size,
+        "privileged": step.privileged,
+    }
+    return (client_key, json.dumps(container_config, sort_keys=True, default=str))
+
+
+def exec_in_warm_container(
+    client: docker.DockerClient,
+    key: tuple,
+    step: Step,
+    volumes: dict[str, dict[str, str]],
+    container_user: str,
+    log_path: Path,
+    warm_containers: WarmContainers = None
+) -> tuple[Container, int]:
+    """Execute the step command in a shared container, write logs to the step log, return the container and exit code."""
+    if warm_containers is None:
+        warm_containers = default_warm_containers
+    container = warm_containers.container(client, key, step, volumes)
+    exec_id = client.api.exec_create(
+        container.id,
+        exec_command(client, step),
+        stdout=True,
+        stderr=True,
+        environment=step.environment,
+        workdir=step.working_dir,
+        user=container_user or "",
+        privileged=bool(step.privileged)
+    )["Id"]
+
+    open(log_path, 'wb').close()
+    if step.short_lived:
+        output = client.api.exec_start(exec_id, stream=False)
+        write_container_logs(step.name, [output], log_path)
+    else:
+        # The exec output stream ends when the step command completes.
+        write_container_logs(step.name, client.api.exec_start(exec_id, stream=True), log_path)
+
+    exit_code = client.api.exec_inspect(exec_id)["ExitCode"]
+    return (container, exit_code)
+
+
+def exec_command(client: docker.DockerClient, step: Step) -> list[str]:
+    """Combine the image entrypoint and the step command (or image default), the way "docker run" would."""
+    image_config = client.images.get(step.image).attrs.get("Config") or {}
+    entrypoint = image_config.get("Entrypoint") or []
+    command = step.command or image_config.get("Cmd") or []
+    if isinstance(command, str):
+        command = shlex.split(command)
+    return entrypoint + command
+
+
+@atexit.register
+def remove_warm_containers():
+    """Stop and remove the containers that steps were sharing outside of run_pipeline()."""
+    default_warm_containers.remove_all()
+
+
+# Size of the step log file write buffer.
+log_file_buffer_size = 1 << 13
+
+# Size of batches of log lines to echo to the proceed log.
+log_buffer_size = 1 << 16
+
+# How long to wait for container logs to finish streaming, after the container process completes.
+log_drain_timeout = 30.0
+
+
+def drain_container_logs(step_name: str, log_stream: Iterable[bytes], log_path: Path) -> Future:
+    """Start write_container_logs() in a background thread, return a Future that completes when the log stream ends.
+
+    Errors from the log stream are raised from the Future's result().
+    """
+    log_drain = Future()
+
+    def drain():
         try:
-            device_requests = []
-            if step.gpus:
-                # This is roughly equivalent to the "--gpus" in "docker run --gpus ...".
-                device_requests.append(docker.types.DeviceRequest(count=-1, capabilities=[["gpu"]]))
-
-            container_user = resolve_user(step.user)
-            if container_user is None:
-                logging.info(f"Container '{step.name}': running as default user (might be root).")
-            else:
-                logging.info(f"Container '{step.name}': running as user {container_user}.")
+            write_container_logs(step_name, log_stream, log_path)
+            log_drain.set_result(None)
+        except BaseException as exception:
+            log_drain.set_exception(exception)
 
-            if step.privileged:
-                logging.warning(f"Container '{step.name}' running in privileged mode.  Please only use this for troubleshooting.")
+    Thread(target=drain, name=f"{step_name} logs", daemon=True).start()
+    return log_drain
 
-            client = docker.from_env(**client_kwargs)
-            container = client.containers.run(
-                step.image,
-                command=step.command,
-                environment=step.environment,
-                device_requests=device_requests,
-                network_mode=step.network_mode,
-                mac_address=step.mac_address,
-                volumes=normalize_volumes(step.volumes),
-                working_dir=step.working_dir,
-                auto_remove=False,
-                remove=False,
-                detach=True,
-                user=container_user,
-                shm_size=step.shm_size,
-                privileged=step.privileged
-            )
-            logging.info(f"Container '{step.name}': waiting for process to complete.")
-
-            # Tail the container logs and write new lines to the step log and the proceed log as they arrive.
-            step_log_stream = container.logs(stdout=True, stderr=True, stream=True)
-            with open(log_path, 'w') as f:
-                for log_entry in step_log_stream:
-                    log = log_entry.decode("utf-8")
-                    f.write(log)
-                    logging.info(f"Step '{step.name}': {log.strip()}")
-
-            # Collect overall logs and status of the finished procedss.
-            run_results = container.wait()
-            exit_code = run_results['StatusCode']
-            logging.info(f"Container '{step.name}': process completed with exit code {exit_code}")
-
-            container.remove()
-
-            return (container, exit_code, None)
-
-        except APIError as api_error:
-            if api_error.is_client_error():
-                # Client errors are not worth retrying, just fail out.
-                logging.error(f"Container had a Docker client error.", exc_info=True)
-                return (None, -1, api_error)
-            else:
-                # Server errors might be transient and are worth retrying.
-                logging.error(f"Container had a Docker server error, will retry.", exc_info=True)
-                retried_exception = api_error
 
-        except DockerException as docker_exception:
-            # The other DockerExceptions besides APIError are probably not worth retrying, so just fail out.
-            # https://github.com/docker/docker-py/blob/main/docker/errors.py
-            logging.error(f"Container had a Docker error.", exc_info=True)
-            return (None, -1, docker_exception)
+def write_container_logs(
+    step_name: str,
+    log_stream: Iterable[bytes],
+    log_path: Path,
+    echo_interval: float = 2.0
+):
+    """Write container log chunks to the step log file, and echo them to the proceed log in batches.
+
+    The step log gets the raw bytes from the container, appended through a write buffer.
+    Echoing each chunk with its own logging call is slow for chatty containers,
+    so collect chunks and echo them together at most every echo_interval seconds or log_buffer_size bytes,
+    and at the end of the stream.
+
+    While a live stream is quiet, a timer still flushes pending echoes and the step log file every echo_interval,
+    so the latest output from long-running steps shows up without waiting for more.
+    """
+    echo_enabled = logging.getLogger().isEnabledFor(logging.INFO)
+    lock = Lock()
+    pending = []
+    pending_size = 0
+    last_flush = None
+
+    with open(log_path, 'ab', buffering=log_file_buffer_size) as f:
+        def flush():
+            # Call with the lock held, so echoes from the timer and the stream stay in order.
+            nonlocal pending, pending_size, last_flush
+            f.flush()
+            if pending:
+                echo_container_logs(step_name, pending)
+                pending = []
+                pending_size = 0
+            last_flush = monotonic()
+
+        stream_done = Event()
+
+        def flush_periodically():
+            while not stream_done.wait(echo_interval):
+                with lock:
+                    flush()
+
+        if isinstance(log_stream, list):
+            # Chunks that are already complete don't need the timer.
+            flusher = None
+        else:
+            flusher = Thread(target=flush_periodically, name=f"{step_name} log flush", daemon=True)
+            flusher.start()
+
+        try:
+            for log_entry in log_stream:
+                with lock:
+                    f.write(log_entry)
+                    if not echo_enabled:
+                        continue
 
-        except Exception as unexpected_exception:
-            # Other exceptions besides DockerException are unexpected!
-            # But we have seen OSError here, for one.
-            # Some of these seem to be transient, so we can retry them.
-            logging.error(f"Container had an unexpected, non-Docker error, will retry", exc_info=True)
-            retried_exception = unexpected_exception
+                    pending.append(log_entry)
+                    pending_size += len(log_entry)
+                    if last_flush is None or pending_size >= log_buffer_size or monotonic() - last_flush >= echo_interval:
+                        flush()
+        finally:
+            stream_done.set()
+            if flusher is not None:
+                flusher.join()
+            with lock:
+                flush()
 
-        attempts += 1
-        retry_log_message = f"Container attempts/retries at {attempts} out of {max_attempts}.\n"
-        with open(log_path, 'a') as f:
-            f.write(retry_log_message)
-        logging.info(retry_log_message.strip())
 
-    # If we got here it means we exhausted max_attempts, so we expect retried_exception to be filed in.
-    return (None, -1, retried_exception)
+def echo_container_logs(step_name: str, log_entries: list[bytes]):
+    log = b"".join(log_entries).decode("utf-8", errors="replace")
+    logging.info(f"Step '{step_name}': {log.strip()}")
 
 
 def normalize_volumes(
@@ -319,12 +1096,11 @@ def normalize_volumes(
     """Convert string paths to full dict form and make relative paths absolute."""
     normalized = {}
     for host_path, volume in volumes.items():
-        host_absolute = Path(host_path).absolute().as_posix()
+        host_absolute = abspath(host_path)
         if isinstance(volume, str):
-            bind_absolute = Path(volume).absolute().as_posix()
+            bind_absolute = abspath(volume)
             normalized[host_absolute] = {"bind": bind_absolute, "mode": default_mode}
         else:
-            bind_absolute = Path(volume["bind"]).absolute().as_posix()
-            volume["bind"] = bind_absolute
-            normalized[host_absolute] = volume
+            bind_absolute = abspath(volume["bind"])
+            normalized[host_absolute] = {**volume, "bind": bind_absolute}
     return normalized
@@ -1,18 +1,272 @@
 import logging
 import hashlib
-from pathlib import Path
+import fnmatch
+import os
+import re
+from typing import Any
+from functools import lru_cache
+from pathlib import Path, PurePosixPath
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 
 
-def match_patterns_in_dirs(dirs: list[str], glob_patterns: list[str]) -> dict[str, dict[str, str]]:
-    """Search each given dir using each given "glob" pattern, return matched files, with content digests, per dir."""
-    matches = {}
+class DirIndex():
+    """Cache listings of individual dirs, so we can match several glob patterns without listing the same dirs again.
+
+    Dirs are listed lazily, only where glob patterns need to look.
+    Listings are kept until they're invalidated, for example after a step container might have changed files.
+    Each dir has a generation that invalidate() bumps, so a listing that was in progress during invalidate() isn't kept.
+    At most max_size listings are kept, forgetting the oldest first.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.listings = {}
+        self.generations = {}
+        self.next_generation = 0
+        self.lock = Lock()
+
+    def entries(self, dir: str) -> list[tuple[str, bool, bool, bool]]:
+        """Get the entries directly within the given dir, as tuples of (name, is_file, is_dir, is_real_dir).
+
+        Like Path.glob(), is_file and is_dir follow symlinks, while is_real_dir is only true for dirs that aren't symlinks.
+        """
+        key = os.path.abspath(dir)
+        with self.lock:
+            if key in self.listings:
+                return self.listings[key]
+            generation = self.generations.get(key)
+            if generation is None:
+                self.next_generation += 1
+                generation = self.generations[key] = self.next_generation
+
+        # List outside the lock so other threads can list other dirs meanwhile.
+        listing = list_entries(key)
+
+        with self.lock:
+            if self.generations.get(key) != generation:
+                # The dir was invalidated while we were listing it, so this listing might be stale.
+                return listing
+
+            self.listings[key] = listing
+            while len(self.listings) > self.max_size:
+                oldest = next(iter(self.listings))
+                del self.listings[oldest]
+                self.generations.pop(oldest, None)
+        return listing
+
+    def prefetch(self, dirs: list[str], max_workers: int = 8):
+        """List several dirs in parallel, ahead of matching files in them.
+
+        This helps when each listing spends most of its time waiting, as on network file systems.
+        """
+        unique_dirs = list(dict.fromkeys(os.path.abspath(dir) for dir in dirs))[:self.max_size]
+        if not unique_dirs:
+            return
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for _ in executor.map(self.entries, unique_dirs):
+                pass
+
+    def invalidate(self, dirs: list[str]):
+        """Forget listings for the given dirs, as well as dirs that contain them or are contained by them."""
+        invalid_paths = [os.path.abspath(dir) for dir in dirs]
+        invalid_prefixes = [os.path.join(path, "") for path in invalid_paths]
+        with self.lock:
+            # This includes dirs that are being listed right now, but aren't stored yet.
+            # Forgetting a generation bumps it, since the next one will be newer than any so far.
+            for key in list(self.generations.keys()):
+                key_prefix = os.path.join(key, "")
+                if any(key_prefix.startswith(prefix) or prefix.startswith(key_prefix) for prefix in invalid_prefixes):
+                    self.listings.pop(key, None)
+                    del self.generations[key]
+
+
+def list_entries(dir: str) -> list[tuple[str, bool, bool, bool]]:
+    """List entries directly within the given dir as tuples of (name, is_file, is_dir, is_real_dir)."""
+    entries = []
+    try:
+        with os.scandir(dir) as dir_entries:
+            for entry in dir_entries:
+                try:
+                    is_real_dir = entry.is_dir(follow_symlinks=False)
+                    entries.append((entry.name, entry.is_file(), is_real_dir or entry.is_dir(), is_real_dir))
+                except OSError:
+                    # Like Path.glob(), skip entries we can't inspect.
+                    continue
+    except OSError:
+        # Like Path.glob(), skip dirs we can't read.
+        pass
+    return entries
+
+
+@lru_cache(maxsize=256)
+def compile_glob(glob_pattern: str) -> tuple[tuple[str, Any], ...]:
+    """Split a relative glob pattern into components, compiling each wildcard component once.
+
+    Returns a tuple of (kind, value) pairs, where kind is "precise" with a literal name,
+    "wildcard" with a compiled regex, or "recursive" for "**".
+    Returns None for patterns Path.glob() treats specially or rejects, so callers can use Path.glob() instead.
+    """
+    if not glob_pattern or glob_pattern.startswith("/") or glob_pattern.endswith("/"):
+        return None
+
+    components = []
+    for part in PurePosixPath(glob_pattern).parts:
+        if part == "**":
+            components.append(("recursive", None))
+        elif "**" in part:
+            return None
+        elif any(c in part for c in "*?["):
+            components.append(("wildcard", re.compile(fnmatch.translate(part))))
+        else:
+            components.append(("precise", part))
+
+    if not components:
+        return None
+    return tuple(components)
+
+
+def pattern_lists_dir(glob_pattern: str) -> bool:
+    """Does matching the given pattern start by listing the dir itself, rather than checking a literal name?"""
+    components = compile_glob(glob_pattern)
+    return components is None or components[0][0] != "precise"
+
+
+@lru_cache(maxsize=256)
+def combine_wildcards(regexes: tuple[re.Pattern, ...]) -> re.Pattern:
+    """Combine several compiled wildcard components into one regex that matches names matched by any of them."""
+    if len(regexes) == 1:
+        return regexes[0]
+    return re.compile("|".join(regex.pattern for regex in regexes))
+
+
+def select_files(dir: str, compiled_patterns: list[tuple[tuple[str, Any], ...]], dir_index: DirIndex) -> list[str]:
+    """Find sorted, relative paths of files within dir that match any of the compiled glob patterns, like Path.glob().
+
+    All the patterns are matched together, in one walk: each dir is visited and listed at most once,
+    and file names in each listing are checked against one combined regex for all the patterns that end there.
+    This only lists dirs that the patterns need to look into, and reuses dir listings from the given dir_index.
+    Literal components are checked directly, without listing dirs at all.
+    """
+    if not os.path.isdir(dir):
+        return []
+
+    matched = set()
+
+    # Pending dirs are relative paths ending in "/", or "" for dir itself,
+    # each with a set of (pattern index, component index) states to match within that dir.
+    # States only move into subdirs, so visiting dirs breadth-first visits each dir once, with all its states.
+    pending = {"": {(pattern_index, 0) for pattern_index in range(len(compiled_patterns))}}
+    while pending:
+        (relative_dir, states) = next(iter(pending.items()))
+        del pending[relative_dir]
+
+        # "**" matches this dir itself, so also match the rest of the pattern here.
+        # A trailing "**" only matches dirs, not files, so there's nothing to do for that.
+        unexpanded = list(states)
+        while unexpanded:
+            (pattern_index, index) = unexpanded.pop()
+            components = compiled_patterns[pattern_index]
+            if components[index][0] == "recursive" and index < len(components) - 1 and (pattern_index, index + 1) not in states:
+                states.add((pattern_index, index + 1))
+                unexpanded.append((pattern_index, index + 1))
+
+        last_wildcards = []
+        dir_wildcards = []
+        recursive_states = []
+        for (pattern_index, index) in states:
+            components = compiled_patterns[pattern_index]
+            (kind, value) = components[index]
+            is_last = index == len(components) - 1
+            if kind == "precise":
+                relative_path = relative_dir + value
+                full_path = os.path.join(dir, relative_path)
+                if is_last:
+                    if os.path.isfile(full_path):
+                        matched.add(relative_path)
+                elif os.path.isdir(full_path):
+                    pending.setdefault(relative_path + "/", set()).add((pattern_index, index + 1))
+            elif kind == "wildcard":
+                if is_last:
+                    last_wildcards.append(value)
+                else:
+                    dir_wildcards.append((value, (pattern_index, index + 1)))
+            elif not is_last:
+                recursive_states.append((pattern_index, index))
+
+        if not (last_wildcards or dir_wildcards or recursive_states):
+            continue
+
+        # Without "**", the same few patterns tend to come up in every dir, so the combined regex is cached.
+        file_match = combine_wildcards(tuple(sorted(set(last_wildcards), key=lambda regex: regex.pattern))) if last_wildcards else None
+        for (name, is_file, is_dir, is_real_dir) in dir_index.entries(os.path.join(dir, relative_dir)):
+            if is_file:
+                if file_match is not None and file_match.fullmatch(name):
+                    matched.add(relative_dir + name)
+            elif is_dir:
+                subdir_states = [state for (regex, state) in dir_wildcards if regex.fullmatch(name)]
+                if is_real_dir:
+                    # Like Path.glob(), "**" doesn't follow symlinks.
+                    subdir_states.extend(recursive_states)
+                if subdir_states:
+                    pending.setdefault(relative_dir + name + "/", set()).update(subdir_states)
+
+    return sorted(matched)
+
+
+def match_patterns_in_dirs(
+    dirs: list[str],
+    glob_patterns: list[str],
+    dir_index: DirIndex = None
+) -> dict[str, dict[str, str]]:
+    """Search each given dir using each given "glob" pattern, return matched files, with content digests, per dir.
+
+    Pass in a shared dir_index to reuse dir listings across calls.
+    """
+    return match_pattern_groups(dirs, {"matches": glob_patterns}, dir_index)["matches"]
+
+
+def match_pattern_groups(
+    dirs: list[str],
+    pattern_groups: dict[str, list[str]],
+    dir_index: DirIndex = None
+) -> dict[str, dict[str, dict[str, str]]]:
+    """Search each given dir using several named groups of "glob" patterns, return matched files per group, per dir.
+
+    This hashes each matched file once, even when several groups match the same file.
+    Pass in a shared dir_index to reuse dir listings across calls.
+    """
+    matches = {name: {} for name in pattern_groups.keys()}
+    if not any(pattern_groups.values()):
+        return matches
+
+    if dir_index is None:
+        dir_index = DirIndex()
+
     for dir in dirs:
-        dir_matches = {}
-        for glob_pattern in glob_patterns:
-            dir_glob_matches = match_pattern_in_dir(dir, glob_pattern)
-            dir_matches.update(dir_glob_matches)
-        if dir_matches:
-            matches[dir] = dir_matches
+        digests = {}
+        for name, glob_patterns in pattern_groups.items():
+            group_matches = {}
+            compiled_patterns = []
+            path_glob_patterns = []
+            for glob_pattern in glob_patterns:
+                components = compile_glob(glob_pattern)
+                if components is None:
+                    path_glob_patterns.append(glob_pattern)
+                else:
+                    compiled_patterns.append(components)
+
+            if compiled_patterns:
+                for path in select_files(dir, compiled_patterns, dir_index):
+                    if path not in digests:
+                        digests[path] = hash_contents(Path(dir, path))
+                    group_matches[path] = digests[path]
+
+            for glob_pattern in path_glob_patterns:
+                group_matches.update(match_pattern_in_dir(dir, glob_pattern))
+            if group_matches:
+                matches[name][dir] = group_matches
     return matches
 
 
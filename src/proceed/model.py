@@ -1,24 +1,151 @@
-from dataclasses import dataclass, field
-from typing import Any, Self, Union
-from string import Template
+from dataclasses import dataclass, field, fields, replace
+from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import islice
+from typing import Any, Callable, Iterable, Self, Union
+import re
+import sys
 
 from proceed.yaml_data import YamlData
 from proceed.__about__ import __version__ as proceed_version
 
 
-def apply_args(x: Any, args: dict[str, str]):
-    """Recursively apply given args to string templates found in x and its elements."""
-    if isinstance(x, str):
-        return Template(x).safe_substitute(args)
-    elif isinstance(x, list):
-        return [apply_args(e, args) for e in x]
-    elif isinstance(x, dict):
-        return {apply_args(k, args): apply_args(v, args) for k, v in x.items()}
+# The same syntax as string.Template: "$$" escapes, "$name" and "${name}" placeholders.
+_ARG_RE = re.compile(r"\$(?:(?P<escaped>\$)|(?P<named>[_a-zA-Z][_a-zA-Z0-9]*)|\{(?P<braced>[_a-zA-Z][_a-zA-Z0-9]*)\})")
+
+
+def _substitute_arg(match: re.Match, args: dict[str, str]) -> str:
+    """Replace one placeholder match like string.Template.safe_substitute(), leaving unknown names as-is."""
+    if match.group("escaped") is not None:
+        return "$"
+    name = match.group("named") or match.group("braced")
+    if name in args:
+        return str(args[name])
+    return match.group(0)
+
+
+def _make_substituter(args: dict[str, str], cache_size: int = 1024) -> Callable[[str], str]:
+    """Build a function that applies the given args to one template string, to reuse across many strings.
+
+    Results are cached per substituter, since steps often repeat the same templates for images, volumes, etc.
+    """
+    if not args:
+        # With no args to apply, only "$$" escapes can change.
+        def sub(x: str) -> str:
+            return x.replace("$$", "$")
     else:
-        return x
+        def replace_match(match: re.Match) -> str:
+            return _substitute_arg(match, args)
 
+        def sub(x: str) -> str:
+            return _ARG_RE.sub(replace_match, x)
+    return lru_cache(maxsize=cache_size)(sub)
 
-@dataclass
+
+def apply_args(x: Any, args: Union[dict[str, str], Callable[[str], str]]):
+    """Recursively apply given args to string templates found in x and its elements.
+
+    The args may be a dict, or a substituter from _make_substituter() to reuse across calls.
+    When nothing changes, this returns x itself rather than a copy.
+    """
+    if callable(args):
+        sub = args
+    else:
+        sub = _make_substituter(args)
+    return _apply_substituter(x, sub)
+
+
+def _apply_substituter(x: Any, sub: Callable[[str], str]):
+    if type(x) is str or not isinstance(x, (list, dict)):
+        return _apply_to_leaf(x, sub, {})
+
+    # Find nested lists and dicts with an explicit stack instead of recursion, parents before children.
+    containers = []
+    pending = [x]
+    while pending:
+        item = pending.pop()
+        item_type = type(item)
+        if item_type is str:
+            continue
+        elif item_type is list or (item_type is not dict and isinstance(item, list)):
+            containers.append(item)
+            pending.extend(item)
+        elif item_type is dict or isinstance(item, dict):
+            containers.append(item)
+            pending.extend(item.values())
+
+    # Amend children before parents, so each parent can look up its amended children by id.
+    amended_containers = {}
+    for container in reversed(containers):
+        # Only copy a container once an element actually changes, otherwise keep the original.
+        amended = None
+        if type(container) is list or isinstance(container, list):
+            for index, e in enumerate(container):
+                amended_e = _apply_to_leaf(e, sub, amended_containers)
+                if amended is not None:
+                    amended.append(amended_e)
+                elif amended_e is not e:
+                    amended = container[:index]
+                    amended.append(amended_e)
+        else:
+            for index, (k, v) in enumerate(container.items()):
+                # Keys are rarely templates, so check plain string keys inline instead of calling _apply_to_leaf().
+                if type(k) is str and "$" not in k:
+                    amended_k = k
+                else:
+                    amended_k = _apply_to_leaf(k, sub, amended_containers)
+                amended_v = _apply_to_leaf(v, sub, amended_containers)
+                if amended is not None:
+                    amended[amended_k] = amended_v
+                elif amended_k is not k or amended_v is not v:
+                    amended = dict(islice(container.items(), index))
+                    amended[amended_k] = amended_v
+        amended_containers[id(container)] = container if amended is None else amended
+    return amended_containers[id(x)]
+
+
+def _apply_to_leaf(x: Any, sub: Callable[[str], str], amended_containers: dict[int, Any]):
+    """Apply args to a string, or look up a list or dict that was already amended."""
+    # Compare exact types first, which is quicker than isinstance() for the usual built-in types.
+    x_type = type(x)
+    if x_type is not str and x_type is not list and x_type is not dict:
+        if isinstance(x, str):
+            x_type = str
+        elif not isinstance(x, (list, dict)):
+            return x
+
+    if x_type is str:
+        if "$" not in x:
+            # Most strings have no templates, so skip the substitution.
+            return x
+        amended = sub(x)
+        return x if amended == x else amended
+    else:
+        return amended_containers[id(x)]
+
+
+def _has_templates(values: Iterable[Any]) -> bool:
+    """Check for "$" in strings within the given values and their nested lists and dicts, stopping at the first."""
+    pending = list(values)
+    while pending:
+        x = pending.pop()
+        x_type = type(x)
+        if x_type is str or isinstance(x, str):
+            if "$" in x:
+                return True
+        elif x_type is list or isinstance(x, list):
+            pending.extend(x)
+        elif x_type is dict or isinstance(x, dict):
+            pending.extend(x.keys())
+            pending.extend(x.values())
+    return False
+
+
+# Step fields that often repeat the same string across steps.
+_interned_step_fields = ["image", "working_dir", "network_mode", "mac_address", "user"]
+
+
+@dataclass(slots=True)
 class Step(YamlData):
     """Specifies a container-based processing step.
 
@@ -194,6 +321,27 @@ class Step(YamlData):
               - any/text/any/subdir/**/*.txt
     """
 
+    depends_on: list[str] = field(default_factory=list)
+    """Names of earlier steps that must finish before this step can start.
+
+    This only matters when steps are allowed to run in parallel,
+    as with ``proceed run --max-parallel ...``.
+    By default steps run one at a time, in the order given.
+
+    When running in parallel, Proceed infers dependencies between steps from their
+    :attr:`volumes` and :attr:`match_done`, :attr:`match_in`, and :attr:`match_out` patterns.
+    Steps that share a volume depend on each other unless they declare match patterns
+    which can't refer to the same files.
+    Use :attr:`depends_on` to declare dependencies that can't be inferred this way.
+
+    .. code-block:: yaml
+
+        steps:
+          - name: download
+          - name: analyze
+            depends_on: [download]
+    """
+
     environment: dict[str, str] = field(default_factory=dict)
     """Environment variables to set inside the step's container.
 
@@ -355,57 +503,144 @@ class Step(YamlData):
             X11: True
     """
 
-    def _with_args_applied(self, args: dict[str, str]) -> Self:
-        """Construct a new Step, the result of applying given args to string fields of this Step."""
-        return Step(
-            name=apply_args(self.name, args),
-            description=apply_args(self.description, args),
-            image=apply_args(self.image, args),
-            command=apply_args(self.command, args),
-            volumes=apply_args(self.volumes, args),
-            working_dir=apply_args(self.working_dir, args),
-            match_done=apply_args(self.match_done, args),
-            match_in=apply_args(self.match_in, args),
-            match_out=apply_args(self.match_out, args),
-            match_summary=apply_args(self.match_summary, args),
-            environment=apply_args(self.environment, args),
-            gpus=apply_args(self.gpus, args),
-            network_mode=apply_args(self.network_mode, args),
-            mac_address=apply_args(self.mac_address, args),
-            user=apply_args(self.user, args),
-            shm_size=apply_args(self.shm_size, args),
-            privileged=apply_args(self.privileged, args),
-            X11=apply_args(self.X11, args)
-        )
+    short_lived: bool = False
+    """Whether to collect the step's container logs all at once, after the container completes.
+
+    This defaults to ``False``, which means Proceed streams container logs as they arrive, for a live view of progress.
+    Set :attr:`short_lived` to ``True`` for quick steps with little output, to skip streaming and
+    fetch all the logs with one request when the container completes.
+
+    .. code-block:: yaml
+
+        steps:
+          - name: quick-glue-step
+            short_lived: True
+    """
+
+    reuse_container: bool = False
+    """Whether to run the step in a container that's kept running and shared with other steps.
+
+    This defaults to ``False``, which means each step gets a new container that's removed when the step completes.
+    Set :attr:`reuse_container` to ``True`` for steps that are quick compared to container startup.
+    Steps with the same :attr:`image`, :attr:`volumes`, :attr:`network_mode`, :attr:`mac_address`,
+    :attr:`shm_size`, and :attr:`privileged` will share one container, executing their
+    :attr:`command` with their own :attr:`environment`, :attr:`working_dir`, and :attr:`user`.
+    Shared containers are removed at the end of the pipeline run.
+
+    Note that steps sharing a container also share any files they write outside of :attr:`volumes`.
+    The image must have a ``tail`` command, used to keep the container running between steps.
+    Steps that request :attr:`gpus` always get their own container.
+
+    .. code-block:: yaml
+
+        steps:
+          - name: quick-step-1
+            reuse_container: True
+          - name: quick-step-2
+            reuse_container: True
+    """
+
+    log_driver: str = None
+    """Docker `logging driver <https://docs.docker.com/config/containers/logging/configure/>`_ for the step's container.
+
+    This defaults to ``local``, which stores logs in a compact format that's cheaper for the Docker daemon
+    than the usual ``json-file`` driver.
+    The driver must support reading logs back, so that Proceed can write the step log.
+
+    .. code-block:: yaml
+
+        steps:
+          - name: json-file-logs
+            log_driver: json-file
+    """
+
+    log_mode: str = None
+    """How the step's container delivers log messages to the :attr:`log_driver`, ``blocking`` or ``non-blocking``.
+
+    This defaults to ``non-blocking``, which means the container process never waits on the Docker daemon to
+    store its logs, and log messages go through a buffer of size :attr:`log_max_buffer`.
+    The tradeoff is that if the process writes logs faster than the daemon can store them and the
+    buffer fills up, new log messages are dropped and will be missing from the step log.
+    Set :attr:`log_mode` to ``blocking`` for steps that need every log line.
+
+    .. code-block:: yaml
+
+        steps:
+          - name: keep-every-log-line
+            log_mode: blocking
+    """
+
+    log_max_buffer: str = None
+    """Size of the log message buffer used when :attr:`log_mode` is ``non-blocking``.
+
+    This defaults to ``25m``.
+    Values with a unit suffix use larger units, for example `10k`, `10m`, or `1g`.
+
+    .. code-block:: yaml
+
+        steps:
+          - name: chatty-step
+            log_max_buffer: 100m
+    """
+
+    def __post_init__(self):
+        # Share one string object for values that repeat across steps, like images and working dirs.
+        # Leave dicts like volumes and environment alone, so they're not rebuilt each time a Step is constructed.
+        for name in _interned_step_fields:
+            value = getattr(self, name)
+            if isinstance(value, str):
+                setattr(self, name, sys.intern(value))
+
+    def _with_args_applied(self, args: Union[dict[str, str], Callable[[str], str]]) -> Self:
+        """Construct a new Step, the result of applying given args to string fields of this Step.
+
+        The args may be a dict, or a substituter from _make_substituter() to reuse across steps.
+        When no fields change, this returns the Step itself.
+        Unchanged lists and dicts are shared with this Step rather than copied, so treat them as read-only.
+        """
+        if not _has_templates(getattr(self, f.name) for f in fields(self)):
+            # Most steps have no templates at all, so skip amending each field.
+            return self
+
+        if not callable(args):
+            args = _make_substituter(args)
+        amended = {f.name: _apply_substituter(getattr(self, f.name), args) for f in fields(self)}
+        if all(value is getattr(self, name) for name, value in amended.items()):
+            return self
+        return Step(**amended)
 
     def _with_prototype_applied(self, prototype: Self) -> Self:
-        """Construct a new Step, the result of accepting default values from the given prototype."""
+        """Construct a new Step, the result of accepting default values from the given prototype.
+
+        Dict fields like :attr:`volumes` and :attr:`environment` are merged, with this Step's entries taking precedence.
+        Other fields take the prototype value when this Step's value is empty.
+        When nothing changes, this returns the Step itself.
+        Lists and dicts taken from the prototype are shared rather than copied, so treat them as read-only.
+        """
         if not prototype:
             return self
 
-        return Step(
-            name=self.name or prototype.name,
-            description=self.description or prototype.description,
-            image=self.image or prototype.image,
-            command=self.command or prototype.command,
-            volumes={**prototype.volumes, **self.volumes},
-            working_dir=self.working_dir or prototype.working_dir,
-            match_done=self.match_done or prototype.match_done,
-            match_in=self.match_in or prototype.match_in,
-            match_out=self.match_out or prototype.match_out,
-            match_summary=self.match_summary or prototype.match_summary,
-            environment={**prototype.environment, **self.environment},
-            gpus=self.gpus or prototype.gpus,
-            network_mode=self.network_mode or prototype.network_mode,
-            mac_address=self.mac_address or prototype.mac_address,
-            user=self.user or prototype.user,
-            shm_size=self.shm_size or prototype.shm_size,
-            privileged=self.privileged or prototype.privileged,
-            X11=self.X11 or prototype.X11
-        )
+        overlay = {}
+        for f in fields(self):
+            value = getattr(self, f.name)
+            default = getattr(prototype, f.name)
+            if isinstance(value, dict) and isinstance(default, dict):
+                if not default:
+                    continue
+                elif not value:
+                    overlay[f.name] = default
+                elif not default.keys() <= value.keys():
+                    # Build plain dicts rather than ChainMap views, so these still dump to YAML.
+                    overlay[f.name] = default | value
+            elif not value and default != value:
+                overlay[f.name] = default
+
+        if not overlay:
+            return self
+        return replace(self, **overlay)
 
 
-@dataclass
+@dataclass(slots=True)
 class Timing(YamlData):
     """Records :class:`Step` and :class:`Pipeline` execution times and durations."""
 
@@ -424,11 +659,25 @@ class Timing(YamlData):
     duration: float = None
     """Duration in seconds from :attr:`start` to :attr:`finish`."""
 
+    @classmethod
+    def from_monotonic(cls, wall_start: datetime, start_ns: int, finish_ns: int = None) -> Self:
+        """Make a Timing from one wall clock datetime at the start, and monotonic clock readings for duration.
+
+        The monotonic clock is cheaper to read and can't jump backwards, so :attr:`finish` is derived from
+        :attr:`start` plus :attr:`duration`, rather than read from the wall clock again.
+        """
+        if finish_ns is None:
+            return cls(wall_start.isoformat(sep="T"))
+
+        duration = (finish_ns - start_ns) / 1e9
+        finish = wall_start + timedelta(seconds=duration)
+        return cls(wall_start.isoformat(sep="T"), finish.isoformat(sep="T"), duration)
+
     def _is_complete(self):
         return self.start is not None and self.finish is not None and self.duration > 0
 
 
-@dataclass
+@dataclass(slots=True)
 class StepResult(YamlData):
     """Records what happened when a :class:`Step` ran."""
 
@@ -571,8 +820,23 @@ class StepResult(YamlData):
     to be already complete before running, and :attr:`skipped` should be ``True``.
     """
 
+    coalesced_with: str = None
+    """Name of an earlier :class:`Step` whose container run was reused for this step, if any.
+
+    When a pipeline runs with ``coalesce_duplicates``, a step with the same container spec as an
+    earlier step doesn't run its own container.
+    Instead it reuses the earlier step's :attr:`exit_code`, :attr:`image_id`, and :attr:`log_file`,
+    and matches its own :attr:`files_in`, :attr:`files_out`, and :attr:`files_summary`.
+
+    .. code-block:: yaml
+
+        step_results:
+          - name: step coalesced example
+            coalesced_with: earlier step
+    """
+
 
-@dataclass
+@dataclass(slots=True)
 class Pipeline(YamlData):
     """Specifies top-level pipeline configuration and processing steps.
 
@@ -751,46 +1015,40 @@ class Pipeline(YamlData):
     If a step stops with a nonzero :attr:`StepResult.exit_code`, the
     pipeline execution will stop at that point.
 
+    When steps are allowed to run in parallel, as with ``proceed run --max-parallel ...``,
+    each step will start as soon as the steps it depends on have finished
+    (see :attr:`Step.depends_on`).
+    If a step stops with a nonzero :attr:`StepResult.exit_code`, no new steps will start,
+    but steps that were already running will finish and be recorded.
+
     After execution, the :class:`ExecutionRecord` will contain a list of
     :class:`StepResult`, one for each of the :attr:`steps` executed.
     """
 
     def _combine_args(self, args: dict[str, str]) -> dict[str, str]:
         """Update self.args with given args values, but don't add new keys."""
-        accepted_args = {}
-        for k in self.args.keys():
-            if k in args.keys():
-                accepted_args[k] = args[k]
-            else:
-                accepted_args[k] = self.args[k]
-        return accepted_args
+        return {k: args.get(k, v) for k, v in self.args.items()}
 
     def _with_args_applied(self, args: dict[str, str]) -> Self:
         """Construct a new Step, the result of applying given args to string fields of this Step."""
         combined_args = self._combine_args(args)
+        sub = _make_substituter(combined_args)
         if self.prototype:
-            amended_prototype = self.prototype._with_args_applied(combined_args)
+            amended_prototype = self.prototype._with_args_applied(sub)
         else:
             amended_prototype = None
-        return Pipeline(
-            version=self.version,
-            description=self.description,
+        return replace(
+            self,
             args=combined_args,
             prototype=amended_prototype,
-            steps=[step._with_args_applied(combined_args) for step in self.steps]
+            steps=[step._with_args_applied(sub) for step in self.steps]
         )
 
     def _with_prototype_applied(self) -> Self:
-        return Pipeline(
-            version=self.version,
-            description=self.description,
-            args=self.args,
-            prototype=self.prototype,
-            steps=[step._with_prototype_applied(self.prototype) for step in self.steps]
-        )
+        return replace(self, steps=[step._with_prototype_applied(self.prototype) for step in self.steps])
 
 
-@dataclass
+@dataclass(slots=True)
 class ExecutionRecord(YamlData):
     """Auditable record of what happened when a :class:`Pipeline` was amended and executed."""
 
@@ -26,6 +26,9 @@ class YamlData():
     field names and types -- these do not write or use custom YAML tags.
     """
 
+    # Declare no slots here, so that @dataclass(slots=True) subclasses don't get a per-instance __dict__.
+    __slots__ = ()
+
     def to_yaml(self, skip_empty: bool = True, dump_args: dict[str, Any] = {}) -> str:
         """Dump self to a plain YAML string without custom YAML tags."""
 
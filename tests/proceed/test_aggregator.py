@@ -1,9 +1,9 @@
 from math import isnan
 from pathlib import Path
 from pytest import fixture
-from proceed.model import Pipeline
+from proceed.model import Pipeline, Step, StepResult
 from proceed.docker_runner import run_pipeline
-from proceed.aggregator import summarize_results, collect_custom_columns
+from proceed.aggregator import summarize_results, collect_custom_columns, pair_steps_and_results
 
 
 @fixture
@@ -44,6 +44,21 @@ def run(pipeline: Pipeline,
     return execution_path
 
 
+def test_pair_steps_and_results():
+    steps = [Step(name="a"), Step(name="b"), Step(name="c"), Step(name="d")]
+
+    # Results can skip steps, for example when "b" had an error and "c" never started, while "d" was already running.
+    step_results = [StepResult(name="a", exit_code=0), StepResult(name="b", exit_code=1), StepResult(name="d", exit_code=0)]
+    steps_and_results = pair_steps_and_results(steps, step_results)
+    assert [(step.name, result.name) for step, result in steps_and_results] == [("a", "a"), ("b", "b"), ("d", "d")]
+
+    # Steps that share a name should be paired with results in order.
+    steps = [Step(name="same", image="first"), Step(name="same", image="second")]
+    step_results = [StepResult(name="same", exit_code=0), StepResult(name="same", exit_code=1)]
+    steps_and_results = pair_steps_and_results(steps, step_results)
+    assert [(step.image, result.exit_code) for step, result in steps_and_results] == [("first", 0), ("second", 1)]
+
+
 def test_pipeline_with_error(pipelines, tmp_path):
     run(pipelines["sad_spec"], tmp_path, results_group="sad_spec")
     summary = summarize_results(tmp_path)
@@ -3,12 +3,19 @@ from grp import getgrgid
 from getpass import getuser
 from pathlib import Path
 from shutil import rmtree
+from threading import Event, Thread
+from types import SimpleNamespace
+from time import monotonic, sleep
+import logging
+import socket
 import docker
+import yaml
 
-from pytest import fixture
+from pytest import fixture, raises
 
 from proceed.model import Pipeline, ExecutionRecord, Step, StepResult
-from proceed.docker_runner import run_pipeline, run_step
+from proceed import docker_runner
+from proceed.docker_runner import WarmContainers, run_pipeline, run_step, write_container_logs, drain_container_logs, docker_client, forget_docker_client, reattach_container, container_log_config, start_step_results, record_step_result, _build_dag, _patterns_might_overlap, _local_socket_instead_of_tcp
 
 
 @fixture
@@ -74,6 +81,23 @@ def test_step_command_success(alpine_image, tmp_path):
     assert "hello to you" in read_step_logs(step_result)
 
 
+def test_step_short_lived(alpine_image, tmp_path):
+    step = Step(name="short lived", image=alpine_image.tags[0], command=["echo", "hello to you"], short_lived=True)
+    step_result = run_step(step, Path(tmp_path, "step.log"))
+    assert step_result.exit_code == 0
+    assert read_step_logs(step_result) == "hello to you\n"
+
+
+def test_container_log_config():
+    default_config = container_log_config(Step(name="default logs"))
+    assert default_config["Type"] == "local"
+    assert default_config["Config"] == {"mode": "non-blocking", "max-buffer-size": "25m"}
+
+    blocking_config = container_log_config(Step(name="blocking logs", log_driver="json-file", log_mode="blocking"))
+    assert blocking_config["Type"] == "json-file"
+    assert blocking_config["Config"] == {"mode": "blocking"}
+
+
 def test_step_working_dir(alpine_image, tmp_path):
     step = Step(name="working dir", working_dir="/home", image=alpine_image.tags[0], command=["pwd"])
     step_result = run_step(step, Path(tmp_path, "step.log"))
@@ -446,6 +470,57 @@ def test_step_files_summary(alpine_image, fixture_path, tmp_path):
     assert not step_result.skipped
 
 
+def test_write_container_logs(tmp_path):
+    # Container log chunks should be written as-is, even if a chunk splits a multi-byte character.
+    log_entries = [b"line 1\n", b"line 2\n", "caf\u00e9\n".encode()[0:4], "caf\u00e9\n".encode()[4:]]
+    log_path = Path(tmp_path, "step.log")
+    write_container_logs("test", log_entries, log_path)
+    with open(log_path, 'r') as f:
+        assert f.read() == "line 1\nline 2\ncaf\u00e9\n"
+
+
+def test_write_container_logs_while_quiet(tmp_path, caplog):
+    # Output from a long-running container should show up even if nothing more comes for a while.
+    log_path = Path(tmp_path, "step.log")
+    stream_may_end = Event()
+
+    def quiet_log_stream():
+        yield b"line 1\n"
+        yield b"line 2\n"
+        stream_may_end.wait(timeout=10)
+
+    caplog.set_level(logging.INFO)
+    writer = Thread(target=write_container_logs, args=("test", quiet_log_stream(), log_path, 0.1))
+    writer.start()
+    try:
+        deadline = monotonic() + 5
+        while "line 2" not in caplog.text and monotonic() < deadline:
+            sleep(0.05)
+        assert "line 2" in caplog.text
+        with open(log_path, 'r') as f:
+            assert f.read() == "line 1\nline 2\n"
+    finally:
+        stream_may_end.set()
+        writer.join()
+
+
+def test_drain_container_logs(tmp_path):
+    log_path = Path(tmp_path, "step.log")
+    log_drain = drain_container_logs("test", [b"line 1\n", b"line 2\n"], log_path)
+    log_drain.result(timeout=10)
+    with open(log_path, 'r') as f:
+        assert f.read() == "line 1\nline 2\n"
+
+    # Errors while streaming logs should come back to the caller.
+    def broken_log_stream():
+        yield b"line 1\n"
+        raise OSError("stream broke")
+
+    log_drain = drain_container_logs("test", broken_log_stream(), log_path)
+    with raises(OSError):
+        log_drain.result(timeout=10)
+
+
 def test_pipeline_with_args(alpine_image, tmp_path):
     pipeline = Pipeline(
         args={
@@ -491,6 +566,28 @@ def test_pipeline_with_args(alpine_image, tmp_path):
     assert read_step_logs(pipeline_result.step_results[0]) == "hello quux\n"
     assert read_step_logs(pipeline_result.step_results[1]) == "hello bar\n"
 
+    # Step results should also be recorded one at a time as steps complete.
+    with open(Path(tmp_path, "step_results.yaml")) as f:
+        recorded_step_results = [StepResult.from_dict(document) for document in yaml.safe_load_all(f)]
+    assert recorded_step_results == expected_step_results
+
+
+def test_record_step_results(tmp_path):
+    step_results_path = Path(tmp_path, "step_results.yaml")
+    stale_result = StepResult(name="stale", exit_code=1)
+    start_step_results(step_results_path)
+    record_step_result(step_results_path, stale_result)
+
+    # Starting again, as when rerunning with the same results id, should forget earlier results.
+    step_results = [StepResult(name="a", exit_code=0), StepResult(name="b", exit_code=0)]
+    start_step_results(step_results_path)
+    for step_result in step_results:
+        record_step_result(step_results_path, step_result)
+
+    with open(step_results_path) as f:
+        recorded_step_results = [StepResult.from_dict(document) for document in yaml.safe_load_all(f)]
+    assert recorded_step_results == step_results
+
 
 def test_pipeline_with_environment(alpine_image, tmp_path):
     pipeline = Pipeline(
@@ -605,6 +702,116 @@ def test_pipeline_steps_to_run(alpine_image, tmp_path):
     assert explicit_run_all.step_results[2].name == "step 3"
 
 
+def test_infer_step_dependencies(tmp_path):
+    shared_dir = Path(tmp_path, "shared").as_posix()
+    other_dir = Path(tmp_path, "other").as_posix()
+    steps = [
+        Step(name="a", volumes={shared_dir: "/shared"}, match_out=["a/*.txt"]),
+        Step(name="b", volumes={shared_dir: "/shared"}, match_in=["a/*.txt"], match_out=["b/*.txt"]),
+        Step(name="c", volumes={shared_dir: "/shared"}, match_out=["c/*.txt"]),
+        Step(name="d", volumes={other_dir: "/other"}),
+        Step(name="e", depends_on=["d", "no such step"]),
+        Step(name="f", volumes={shared_dir: "/shared"}),
+    ]
+    (predecessors, successors) = _build_dag(steps)
+
+    # Steps depend on earlier steps that might write their files, or that they name explicitly.
+    assert predecessors == [set(), {0}, set(), set(), {3}, {0, 1, 2}]
+    assert successors == [{1, 5}, {5}, {5}, {4}, set(), set()]
+
+    # Wildcard patterns that could match the same file should count as overlapping.
+    steps = [
+        Step(name="csv out", volumes={shared_dir: "/shared"}, match_out=["data_*.csv"]),
+        Step(name="csv in", volumes={shared_dir: "/shared"}, match_in=["*_2023.csv"], match_out=["results/*.csv"]),
+        Step(name="txt out", volumes={shared_dir: "/shared"}, match_out=["**/*.txt"]),
+        Step(name="txt in", volumes={shared_dir: "/shared"}, match_in=["x.txt"], match_out=["y.json"]),
+    ]
+    (predecessors, successors) = _build_dag(steps)
+    assert predecessors == [set(), {0}, set(), {2}]
+
+    # Patterns that can't match the same file should still let steps run independently.
+    assert not _patterns_might_overlap("data_*.csv", "*.json")
+    assert not _patterns_might_overlap("a/**/*.txt", "b/*.txt")
+    assert not _patterns_might_overlap("data_*.csv", "info_*.csv")
+    assert _patterns_might_overlap("a/**/*.txt", "a/b/c/x.txt")
+
+
+def test_pipeline_reuse_container(alpine_image, tmp_path):
+    # Steps that reuse a container should see files written by earlier steps, even outside of volumes.
+    pipeline = Pipeline(
+        steps=[
+            Step(name="step 1", image=alpine_image.tags[0], command=["touch", "/tmp/shared"], reuse_container=True),
+            Step(name="step 2", image=alpine_image.tags[0], command=["ls", "/tmp/shared"], reuse_container=True)
+        ]
+    )
+    pipeline_result = run_pipeline(pipeline, tmp_path)
+    assert [step_result.exit_code for step_result in pipeline_result.step_results] == [0, 0]
+    assert read_step_logs(pipeline_result.step_results[1]) == "/tmp/shared\n"
+
+
+def test_pipeline_in_parallel(alpine_image, tmp_path):
+    pipeline = Pipeline(
+        steps=[
+            Step(name="step 1", image=alpine_image.tags[0], command=["sleep", "1"]),
+            Step(name="step 2", image=alpine_image.tags[0], command=["sleep", "1"]),
+            Step(name="step 3", image=alpine_image.tags[0], command=["echo", "hello 3"], depends_on=["step 1"])
+        ]
+    )
+    pipeline_result = run_pipeline(pipeline, tmp_path, max_parallel=2)
+
+    # Results should be in step order, regardless of which steps finished first.
+    assert [step_result.name for step_result in pipeline_result.step_results] == ["step 1", "step 2", "step 3"]
+    assert all([step_result.exit_code == 0 for step_result in pipeline_result.step_results])
+    assert read_step_logs(pipeline_result.step_results[2]) == "hello 3\n"
+
+    # Independent steps 1 and 2 should overlap, step 3 should wait for step 1.
+    (step_1, step_2, step_3) = [step_result.timing for step_result in pipeline_result.step_results]
+    assert step_2.start < step_1.finish
+    assert step_3.start >= step_1.finish
+
+
+def test_pipeline_coalesce_duplicates(alpine_image, tmp_path):
+    # Two steps run the same container but match different output files.
+    data_dir = Path(tmp_path, "data").as_posix()
+    command = ["sh", "-c", "echo a > /data/a.txt; echo b > /data/b.txt; echo done"]
+    pipeline = Pipeline(
+        steps=[
+            Step(name="step a", image=alpine_image.tags[0], volumes={data_dir: "/data"}, command=command, match_out=["a.txt"]),
+            Step(name="step b", image=alpine_image.tags[0], volumes={data_dir: "/data"}, command=command, match_out=["b.txt"])
+        ]
+    )
+    for max_parallel in [1, 2]:
+        rmtree(data_dir, ignore_errors=True)
+        pipeline_result = run_pipeline(pipeline, tmp_path, max_parallel=max_parallel, coalesce_duplicates=True)
+        (step_a, step_b) = pipeline_result.step_results
+        assert step_a.exit_code == 0
+        assert step_a.coalesced_with is None
+        assert list(step_a.files_out[data_dir].keys()) == ["a.txt"]
+
+        # The second step should reuse the first step's container run, but match its own files.
+        assert step_b.exit_code == 0
+        assert step_b.coalesced_with == "step a"
+        assert step_b.log_file == step_a.log_file
+        assert list(step_b.files_out[data_dir].keys()) == ["b.txt"]
+        assert read_step_logs(step_b) == "done\n"
+
+
+def test_pipeline_in_parallel_stops_after_error(alpine_image, tmp_path):
+    pipeline = Pipeline(
+        steps=[
+            Step(name="bad", image=alpine_image.tags[0], command=["ls", "no_such_dir"]),
+            Step(name="slow", image=alpine_image.tags[0], command=["sleep", "1"]),
+            Step(name="after bad", image=alpine_image.tags[0], command=["echo", "after bad"], depends_on=["bad"])
+        ]
+    )
+    pipeline_result = run_pipeline(pipeline, tmp_path, max_parallel=2)
+
+    # The slow step was already running and should finish, but no new steps should start after the error.
+    assert [step_result.name for step_result in pipeline_result.step_results] == ["bad", "slow"]
+    assert pipeline_result.step_results[0].exit_code == 1
+    assert pipeline_result.step_results[1].exit_code == 0
+
+
 def test_fail_on_docker_exception(alpine_image, tmp_path):
     # Misconfigure the docker client to cause a DockerException.
     bad_client_kwargs = {
@@ -621,6 +828,58 @@ def test_fail_on_docker_exception(alpine_image, tmp_path):
     assert "should not get this far!" not in logs
 
 
+def test_reuse_docker_client():
+    client = docker_client()
+    assert docker_client() is client
+
+    forget_docker_client()
+    assert docker_client() is not client
+
+
+def test_reattach_container(alpine_image):
+    client = docker_client()
+    container = client.containers.run(alpine_image.tags[0], command=["echo", "hello"], detach=True)
+    container.wait()
+
+    reattached = reattach_container(client, container, "reattach")
+    assert reattached.id == container.id
+
+    container.remove()
+    assert reattach_container(client, container, "reattach") is None
+
+
+def test_prefer_local_socket_over_local_tcp(tmp_path, monkeypatch):
+    # Use a real unix socket in place of the Docker daemon's socket.
+    socket_path = Path(tmp_path, "docker.sock")
+    local_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    local_socket.bind(socket_path.as_posix())
+    monkeypatch.setattr(docker_runner, "local_docker_socket", socket_path.as_posix())
+
+    # A local TCP daemon should be reached through the local socket, when asked.
+    local_tcp = {"DOCKER_HOST": "tcp://127.0.0.1:2375"}
+    assert _local_socket_instead_of_tcp({"environment": local_tcp, "prefer_local_socket": True}) == f"unix://{socket_path.as_posix()}"
+
+    # Otherwise, local TCP might be a different daemon, like an SSH tunnel or docker-in-docker.
+    assert _local_socket_instead_of_tcp({"environment": local_tcp}) is None
+    assert _local_socket_instead_of_tcp({"environment": local_tcp, "prefer_local_socket": False}) is None
+
+    # TLS settings mean the TCP daemon was configured on purpose.
+    for tls_variable in ["DOCKER_TLS_VERIFY", "DOCKER_CERT_PATH", "DOCKER_TLS"]:
+        tls_environment = {**local_tcp, tls_variable: "1"}
+        assert _local_socket_instead_of_tcp({"environment": tls_environment, "prefer_local_socket": True}) is None
+    assert _local_socket_instead_of_tcp({"environment": local_tcp, "tls": True, "prefer_local_socket": True}) is None
+
+    # Remote daemons and explicit base_url should be used as-is.
+    assert _local_socket_instead_of_tcp({"environment": {"DOCKER_HOST": "tcp://remote:2375"}, "prefer_local_socket": True}) is None
+    assert _local_socket_instead_of_tcp({"environment": local_tcp, "base_url": "tcp://127.0.0.1:2375", "prefer_local_socket": True}) is None
+    assert _local_socket_instead_of_tcp({"environment": {"DOCKER_HOST": "unix:///var/run/docker.sock"}, "prefer_local_socket": True}) is None
+
+    # Without the socket, stick with TCP.
+    local_socket.close()
+    socket_path.unlink()
+    assert _local_socket_instead_of_tcp({"environment": local_tcp, "prefer_local_socket": True}) is None
+
+
 def test_retry_on_unexpected_exception(alpine_image, tmp_path):
     # Misconfigure the docker client to cause a TypeError.
     bad_client_kwargs = "this is not even a dict!"
@@ -763,6 +1022,47 @@ def test_X11_xauthority_env(alpine_image, tmp_path):
     assert "XAUTHORITY=/var/.Xauthority" in logs
 
 
+def test_pipeline_records_X11_setup(tmp_path, monkeypatch):
+    # The amended pipeline in the execution record should show the X11 setup each step actually ran with.
+    environ["DISPLAY"] = ":42"
+    xauthority_tmp = Path(tmp_path, "test", ".XAuthority")
+    xauthority_tmp.parent.mkdir(parents=True, exist_ok=True)
+    xauthority_tmp.touch()
+    environ["XAUTHORITY"] = xauthority_tmp.as_posix()
+
+    ran_steps = []
+
+    def stub_run_container(step, log_path, client_kwargs={}, max_attempts=3, warm_containers=None):
+        ran_steps.append(step)
+        log_path.write_text("")
+        return (SimpleNamespace(image=SimpleNamespace(id="sha256:stub")), 0, None)
+
+    monkeypatch.setattr(docker_runner, "run_container", stub_run_container)
+    pipeline = Pipeline(
+        steps=[
+            Step(name="step 1", image="stub", X11=True),
+            Step(name="step 2", image="stub", X11=False)
+        ]
+    )
+    pipeline_result = run_pipeline(pipeline, tmp_path)
+
+    step_1_amended = pipeline_result.amended.steps[0]
+    assert step_1_amended == ran_steps[0]
+    assert step_1_amended.environment["DISPLAY"] == ":42"
+    assert step_1_amended.environment["XAUTHORITY"] == "/var/.Xauthority"
+    assert step_1_amended.volumes[xauthority_tmp.as_posix()] == "/var/.Xauthority"
+    assert step_1_amended.volumes["/tmp/.X11-unix"] == "/tmp/.X11-unix"
+    assert step_1_amended.network_mode == "host"
+
+    step_2_amended = pipeline_result.amended.steps[1]
+    assert step_2_amended == ran_steps[1]
+    assert step_2_amended.environment == {}
+    assert step_2_amended.network_mode is None
+
+    # The original pipeline should be left as it was.
+    assert pipeline.steps[0].environment == {}
+
+
 def test_pipeline_with_X11(alpine_image, tmp_path):
     # Ensure /tmp/.X11-unix exists on the host.
     # This should then exist in the container at the same path.
@@ -832,3 +1132,52 @@ def test_pipeline_with_X11(alpine_image, tmp_path):
     assert xauthority_host not in step_2_amended.volumes
     assert "/tmp/.X11-unix" not in step_2_amended.volumes
     assert step_2_amended.network_mode is None
+
+
+def test_warm_containers_per_key_and_per_run():
+    class FakeContainer():
+        def __init__(self, name):
+            self.id = name
+            self.status = "running"
+            self.removed = False
+
+        def reload(self):
+            pass
+
+        def remove(self, force=False):
+            self.removed = True
+
+    slow_start = Event()
+    started_slow = Event()
+
+    def run(image, **kwargs):
+        if image == "slow":
+            # Like pulling an image before starting the container.
+            started_slow.set()
+            slow_start.wait(timeout=10)
+        return FakeContainer(image)
+
+    client = SimpleNamespace(containers=SimpleNamespace(run=run))
+    run_1 = WarmContainers()
+    run_2 = WarmContainers()
+
+    # Starting one shared container shouldn't hold up getting another.
+    slow_containers = []
+    slow_thread = Thread(target=lambda: slow_containers.append(run_1.container(client, "slow key", Step(name="slow", image="slow"), {})))
+    slow_thread.start()
+    assert started_slow.wait(timeout=10)
+    fast_container = run_1.container(client, "fast key", Step(name="fast", image="fast"), {})
+    assert not slow_containers
+    slow_start.set()
+    slow_thread.join(timeout=10)
+    assert run_1.container(client, "slow key", Step(name="slow", image="slow"), {}) is slow_containers[0]
+
+    # Each run should remove its own shared containers, only.
+    other_container = run_2.container(client, "fast key", Step(name="other", image="fast"), {})
+    assert other_container is not fast_container
+    run_1.remove_all()
+    assert fast_container.removed
+    assert slow_containers[0].removed
+    assert not other_container.removed
+    run_2.remove_all()
+    assert other_container.removed
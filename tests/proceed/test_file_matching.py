@@ -1,6 +1,8 @@
 from pathlib import Path
+from threading import Event, Thread
 from pytest import fixture
-from proceed.file_matching import count_matches, flatten_matches, match_patterns_in_dirs
+from proceed import file_matching
+from proceed.file_matching import DirIndex, list_entries, compile_glob, count_matches, flatten_matches, match_patterns_in_dirs, match_pattern_groups, match_pattern_in_dir, pattern_lists_dir
 
 
 @fixture
@@ -44,6 +46,201 @@ def test_ignore_directories(fixture_path):
     assert count_matches(matched_files) == 3
 
 
+def test_match_same_as_path_glob(fixture_path):
+    fixture_dir = fixture_path.as_posix()
+    glob_patterns = [
+        "*",
+        "**/*",
+        "**/*.yaml",
+        "*/*.json",
+        "custom_columns/*",
+        "custom_columns/**/*.yaml",
+        "config_options/[!c]*.yaml",
+        "?appy_spec.yaml",
+        "./happy_spec.yaml",
+        "**",
+        "config_options/",
+        "custom_columns/list.yaml",
+    ]
+    for glob_pattern in glob_patterns:
+        expected_files = match_pattern_in_dir(fixture_dir, glob_pattern)
+        matched_files = match_patterns_in_dirs([fixture_dir], [glob_pattern])
+        assert matched_files.get(fixture_dir, {}) == expected_files
+
+    # Matching all patterns at once should be the same as matching them one at a time.
+    all_expected_files = {}
+    for glob_pattern in glob_patterns:
+        all_expected_files.update(match_pattern_in_dir(fixture_dir, glob_pattern))
+    all_matched_files = match_patterns_in_dirs([fixture_dir], glob_patterns)
+    assert all_matched_files[fixture_dir] == all_expected_files
+
+
+def test_compile_glob_once():
+    components = compile_glob("**/*.yaml")
+    assert compile_glob("**/*.yaml") is components
+    assert [kind for kind, _ in components] == ["recursive", "wildcard"]
+
+    # Literal components are kept as names, to check directly.
+    assert compile_glob("./custom_columns/list.yaml") == (("precise", "custom_columns"), ("precise", "list.yaml"))
+
+    # Patterns that Path.glob() treats specially are left to Path.glob().
+    assert compile_glob("foo**.yaml") is None
+    assert compile_glob("config_options/") is None
+
+
+def test_pattern_lists_dir():
+    assert not pattern_lists_dir("done.txt")
+    assert not pattern_lists_dir("results/*.txt")
+    assert pattern_lists_dir("*.txt")
+    assert pattern_lists_dir("**/done.txt")
+
+
+def test_match_pattern_groups(fixture_path):
+    fixture_dir = fixture_path.as_posix()
+    pattern_groups = {
+        "specs": ["*spec.yaml"],
+        "yaml": ["**/*.yaml"],
+        "none": [],
+    }
+    matched_groups = match_pattern_groups([fixture_dir], pattern_groups)
+    assert matched_groups["specs"] == match_patterns_in_dirs([fixture_dir], ["*spec.yaml"])
+    assert matched_groups["yaml"] == match_patterns_in_dirs([fixture_dir], ["**/*.yaml"])
+    assert matched_groups["none"] == {}
+
+
+def test_reuse_dir_listings(tmp_path):
+    dir_index = DirIndex()
+    data_dir = Path(tmp_path, "data")
+    data_dir.mkdir()
+    Path(data_dir, "a.txt").write_text("a")
+    data_dir_posix = data_dir.as_posix()
+
+    first_matches = match_patterns_in_dirs([data_dir_posix], ["*.txt"], dir_index)
+    assert list(first_matches[data_dir_posix].keys()) == ["a.txt"]
+
+    # A new file is not noticed until the cached listing is invalidated.
+    Path(data_dir, "b.txt").write_text("b")
+    cached_matches = match_patterns_in_dirs([data_dir_posix], ["*.txt"], dir_index)
+    assert cached_matches == first_matches
+
+    # Invalidating a parent dir also invalidates its subdirs.
+    dir_index.invalidate([tmp_path.as_posix()])
+    fresh_matches = match_patterns_in_dirs([data_dir_posix], ["*.txt"], dir_index)
+    assert list(fresh_matches[data_dir_posix].keys()) == ["a.txt", "b.txt"]
+
+    # Prefetched listings should be used for matching later on.
+    Path(tmp_path, "other").mkdir()
+    Path(tmp_path, "other", "c.txt").write_text("c")
+    dir_index.prefetch([data_dir_posix, Path(tmp_path, "other").as_posix()])
+    assert dir_index.entries(Path(tmp_path, "other").as_posix()) == [("c.txt", True, False, False)]
+
+
+def test_keep_no_listing_invalidated_while_listing(tmp_path, monkeypatch):
+    data_dir = Path(tmp_path, "data")
+    data_dir.mkdir()
+    Path(data_dir, "a.txt").write_text("a")
+    data_dir_posix = data_dir.as_posix()
+
+    # Hold up listing the dir until it's been invalidated and changed.
+    listing_started = Event()
+    invalidated = Event()
+
+    def slow_list_entries(dir):
+        listing = list_entries(dir)
+        listing_started.set()
+        invalidated.wait(timeout=10)
+        return listing
+
+    monkeypatch.setattr(file_matching, "list_entries", slow_list_entries)
+    dir_index = DirIndex()
+    stale_listings = []
+    listing_thread = Thread(target=lambda: stale_listings.append(dir_index.entries(data_dir_posix)))
+    listing_thread.start()
+    assert listing_started.wait(timeout=10)
+
+    Path(data_dir, "b.txt").write_text("b")
+    dir_index.invalidate([tmp_path.as_posix()])
+    invalidated.set()
+    listing_thread.join(timeout=10)
+    assert [entry[0] for entry in stale_listings[0]] == ["a.txt"]
+
+    # The stale listing should not have been kept, so the new file is noticed.
+    assert data_dir_posix not in dir_index.listings
+    fresh_matches = match_patterns_in_dirs([data_dir_posix], ["*.txt"], dir_index)
+    assert list(fresh_matches[data_dir_posix].keys()) == ["a.txt", "b.txt"]
+
+
+def test_list_only_dirs_patterns_need(tmp_path):
+    for index in range(10):
+        deep_dir = Path(tmp_path, f"sub_{index}", "deeper")
+        deep_dir.mkdir(parents=True)
+        Path(deep_dir, "file.txt").write_text("deep")
+    Path(tmp_path, "done.txt").write_text("done")
+    Path(tmp_path, "sub_0", "a.txt").write_text("a")
+    tmp_dir = tmp_path.as_posix()
+
+    # Literal patterns don't need any dir listings.
+    dir_index = DirIndex()
+    assert list(match_patterns_in_dirs([tmp_dir], ["done.txt", "sub_0/a.txt"], dir_index)[tmp_dir]) == ["done.txt", "sub_0/a.txt"]
+    assert dir_index.listings == {}
+
+    # Wildcards without "**" only list dirs as deep as the pattern goes.
+    dir_index = DirIndex()
+    assert list(match_patterns_in_dirs([tmp_dir], ["*/*.txt"], dir_index)[tmp_dir]) == ["sub_0/a.txt"]
+    assert len(dir_index.listings) == 11
+    assert not any(key.endswith("deeper") for key in dir_index.listings)
+
+    # "**" lists the subtree under its literal prefix, only.
+    dir_index = DirIndex()
+    assert list(match_patterns_in_dirs([tmp_dir], ["sub_0/**/*.txt"], dir_index)[tmp_dir]) == ["sub_0/a.txt", "sub_0/deeper/file.txt"]
+    assert len(dir_index.listings) == 2
+
+
+def test_match_patterns_together(tmp_path):
+    for index in range(3):
+        Path(tmp_path, f"sub_{index}", "deeper").mkdir(parents=True)
+        Path(tmp_path, f"sub_{index}", "deeper", "file.txt").write_text("deep")
+        Path(tmp_path, f"sub_{index}", "file.csv").write_text("csv")
+    Path(tmp_path, "done.txt").write_text("done")
+    tmp_dir = tmp_path.as_posix()
+
+    class CountingDirIndex(DirIndex):
+        def __init__(self):
+            super().__init__()
+            self.listed = []
+
+        def entries(self, dir):
+            self.listed.append(dir)
+            return super().entries(dir)
+
+    # Several patterns that look into the same dirs should visit each dir once, for all the patterns.
+    glob_patterns = ["*.txt", "*/*.csv", "**/*.txt", "sub_0/**/*", "*/deeper/*.txt"]
+    dir_index = CountingDirIndex()
+    matched_files = match_patterns_in_dirs([tmp_dir], glob_patterns, dir_index)
+    assert len(dir_index.listed) == len(set(dir_index.listed)) == 7
+
+    expected_files = {}
+    for glob_pattern in glob_patterns:
+        expected_files.update(match_pattern_in_dir(tmp_dir, glob_pattern))
+    assert matched_files[tmp_dir] == expected_files
+
+
+def test_symlinks_same_as_path_glob(tmp_path):
+    real_dir = Path(tmp_path, "real")
+    Path(real_dir, "nested").mkdir(parents=True)
+    Path(real_dir, "a.txt").write_text("a")
+    Path(real_dir, "nested", "b.txt").write_text("b")
+    Path(tmp_path, "linked").symlink_to(real_dir, target_is_directory=True)
+    Path(tmp_path, "linked.txt").symlink_to(Path(real_dir, "a.txt"))
+    tmp_dir = tmp_path.as_posix()
+
+    # Wildcards follow symlinks but "**" does not, and one symlinked dir shouldn't affect other patterns.
+    for glob_pattern in ["*", "*/*.txt", "**/*.txt", "linked/**/*.txt", "*/nested/*", "linked/a.txt"]:
+        expected_files = match_pattern_in_dir(tmp_dir, glob_pattern)
+        matched_files = match_patterns_in_dirs([tmp_dir], [glob_pattern])
+        assert matched_files.get(tmp_dir, {}) == expected_files
+
+
 def test_flatten_empty():
     empty_matches = {}
     flattened = flatten_matches(empty_matches)
@@ -1,4 +1,6 @@
-from proceed.model import apply_args, Pipeline, Step
+from datetime import datetime, timezone
+from string import Template
+from proceed.model import apply_args, _make_substituter, ExecutionRecord, Pipeline, Step, StepResult, Timing
 
 pipeline_spec = """
   version: 0.0.42
@@ -211,6 +213,118 @@ def test_apply_args_to_string():
     assert amended == "this is a template foobarbaz"
 
 
+def test_apply_args_like_string_template():
+    args = {
+        "variable": "bar",
+        "_under_score9": "baz",
+        "number": 42
+    }
+    originals = [
+        "$variable",
+        "${variable}",
+        "$variable$variable",
+        "$$variable",
+        "$$$variable",
+        "${variable",
+        "$variable}",
+        "$unknown and ${unknown}",
+        "$_under_score9 $number",
+        "$VARIABLE",
+        "$ lonely $",
+        "$9 ${9} ${}",
+        "$variable-suffix $variablesuffix",
+        "trailing $",
+    ]
+    for original in originals:
+        assert apply_args(original, args) == Template(original).safe_substitute(args)
+
+
+def test_apply_args_to_plain_string():
+    original = "this is not a template"
+    args = {
+        "variable": "bar"
+    }
+    amended = apply_args(original, args)
+    assert amended is original
+
+
+def test_apply_no_args():
+    # Without args, only "$$" escapes should change, like string.Template.
+    assert apply_args("$$escaped $unknown", {}) == "$escaped $unknown"
+
+    plain_step = Step(name="plain", image="image", command=["echo", "hello"])
+    assert plain_step._with_args_applied({}) is plain_step
+
+    escaped_step = Step(name="escaped", image="image", command=["echo", "$$HOME"])
+    assert escaped_step._with_args_applied({}).command == ["echo", "$HOME"]
+
+
+def test_apply_args_unchanged():
+    # When nothing changes, apply_args should return the original objects, not copies.
+    args = {"variable": "bar"}
+    original_list = ["constant", "$unknown"]
+    assert apply_args(original_list, args) is original_list
+    original_dict = {"key": ["constant"], "$unknown": "value"}
+    assert apply_args(original_dict, args) is original_dict
+
+    # When something does change, elements before and after it should be kept in order.
+    changed_list = ["a", "$variable", "c"]
+    assert apply_args(changed_list, args) == ["a", "bar", "c"]
+    changed_dict = {"a": "a", "$variable": "$variable", "c": "c"}
+    assert list(apply_args(changed_dict, args).items()) == [("a", "a"), ("bar", "bar"), ("c", "c")]
+
+    plain_step = Step(name="plain", image="image", command=["echo", "hello"], environment={"foo": "bar"})
+    assert plain_step._with_args_applied(args) is plain_step
+
+    templated_step = Step(name="templated", image="image", command=["echo", "$variable"], environment={"foo": "bar"})
+    amended_step = templated_step._with_args_applied(args)
+    assert amended_step.command == ["echo", "bar"]
+    assert amended_step.environment is templated_step.environment
+
+
+def test_apply_args_with_substituter():
+    # A substituter built once should apply args the same as the args dict itself.
+    args = {"variable": "bar"}
+    sub = _make_substituter(args)
+    original = ["$variable", {"$variable": "${variable}s $$escaped $unknown"}]
+    assert apply_args(original, sub) == apply_args(original, args)
+
+    steps = [Step(name=f"step-{i}", image="image", command=["echo", "$variable"]) for i in range(3)]
+    for step in steps:
+        assert step._with_args_applied(sub) == step._with_args_applied(args)
+
+    # Repeated templates should come from the substituter's cache.
+    assert sub.cache_info().hits > 0
+
+
+def test_apply_args_to_subclasses():
+    # Subclasses of str, list, and dict should get args applied like the built-in types.
+    class MyStr(str):
+        pass
+
+    class MyList(list):
+        pass
+
+    class MyDict(dict):
+        pass
+
+    original = MyList([MyStr("$variable"), MyDict({MyStr("$variable"): MyStr("$variable")})])
+    amended = apply_args(original, {"variable": "bar"})
+    assert amended == ["bar", {"bar": "bar"}]
+
+
+def test_apply_args_deeply_nested():
+    # Deep nesting should not hit the recursion limit.
+    depth = 5000
+    original = "$variable"
+    for _ in range(depth):
+        original = [{"key": original}]
+    amended = apply_args(original, {"variable": "bar"})
+    for _ in range(depth):
+        amended = amended[0]["key"]
+    assert amended == "bar"
+
+
 def test_apply_args_to_dictionary():
     original = {"$variable": "the key for this value is $variable"}
     args = {
@@ -328,3 +442,89 @@ def test_apply_prototype_to_steps():
         ]
     )
     assert amended == expected
+
+
+def test_apply_prototype_unchanged():
+    step = Step(name="step", image="image:step", environment={"env": "step"}, short_lived=True)
+
+    # Prototype values that a step already has should leave the step as-is.
+    same_prototype = Step(name="prototype", environment={"env": "prototype"})
+    assert step._with_prototype_applied(same_prototype) is step
+
+    # Any field can come from the prototype, without listing each one.
+    prototype = Step(reuse_container=True, log_mode="blocking")
+    amended = step._with_prototype_applied(prototype)
+    assert amended == Step(
+        name="step",
+        image="image:step",
+        environment={"env": "step"},
+        short_lived=True,
+        reuse_container=True,
+        log_mode="blocking"
+    )
+    assert step.reuse_container is False
+
+
+def test_step_interns_strings():
+    # Separately built but equal strings should end up as one shared object.
+    image = "".join(["image:", "tag"])
+    step_a = Step(name="a", image=image)
+    step_b = Step(name="b", image="image:tag")
+    assert step_a.image is step_b.image
+
+    # Dict fields should be kept as given, not rebuilt.
+    volumes = {"".join(["/host", "/dir"]): "/container"}
+    environment = {"".join(["ENV", "_VAR"]): "value"}
+    step = Step(volumes=volumes, environment=environment)
+    assert step.volumes is volumes
+    assert step.environment is environment
+
+
+def test_model_slots():
+    # Model instances use slots instead of a per-instance __dict__, and still round-trip through YAML.
+    step = Step(name="step", image="image")
+    assert not hasattr(step, "__dict__")
+    assert Step.from_yaml(step.to_yaml()) == step
+
+    record = ExecutionRecord(
+        original=Pipeline(steps=[step]),
+        amended=Pipeline(steps=[step]),
+        timing=Timing(duration=1.0),
+        step_results=[StepResult(name="step", timing=Timing(duration=0.5), exit_code=0)]
+    )
+    for instance in [record, record.original, record.timing, record.step_results[0]]:
+        assert not hasattr(instance, "__dict__")
+    assert ExecutionRecord.from_yaml(record.to_yaml()) == record
+
+
+def test_step_result_equality():
+    files = {"/host/a": {"a.txt": "sha256:a", "b.txt": "sha256:b"}, "/host/b": {"c.txt": "sha256:c"}}
+    reordered_files = {"/host/b": {"c.txt": "sha256:c"}, "/host/a": {"b.txt": "sha256:b", "a.txt": "sha256:a"}}
+    result = StepResult(name="step", exit_code=0, files_out=files, timing=Timing(duration=1.0))
+    same_result = StepResult(name="step", exit_code=0, files_out=reordered_files, timing=Timing(duration=2.0))
+
+    # Equality follows the compared fields, regardless of dict order or timing.
+    assert result == same_result
+    assert result != StepResult(name="step", exit_code=0, files_in=files)
+
+    # Changes to fields, including changes in place to nested file dicts, should show up right away.
+    same_result.files_out["/host/a"]["a.txt"] = "sha256:changed"
+    assert result != same_result
+    same_result.files_out["/host/a"]["a.txt"] = "sha256:a"
+    assert result == same_result
+    same_result.exit_code = 1
+    assert result != same_result
+
+    assert StepResult.from_yaml(result.to_yaml()) == result
+
+
+def test_timing_from_monotonic():
+    wall_start = datetime(2023, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+    timing = Timing.from_monotonic(wall_start, 1_000_000_000, 3_500_000_000)
+    assert timing.start == "2023-01-02T03:04:05+00:00"
+    assert timing.finish == "2023-01-02T03:04:07.500000+00:00"
+    assert timing.duration == 2.5
+    assert timing._is_complete()
+
+    start_only = Timing.from_monotonic(wall_start, 1_000_000_000)
+    assert start_only == Timing("2023-01-02T03:04:05+00:00")